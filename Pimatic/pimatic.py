@@ -33,16 +33,61 @@ This script does not handle diploid genotypes.
 The code is written for a data set in which the first two columns are
 chromosome and position.
 '''
-from collections import defaultdict
+from collections import defaultdict, deque
+from fractions import gcd
+import heapq
+from itertools import chain
+import multiprocessing
 import optparse
+import os
 import sys
 
-VERSION = '17.04.20'
+import numpy as np
+
+VERSION = '26.10.18'
 NAME = 'Pimatic'
 descr = """
 This script calculates Pi for multiple. This is based on a script published in
 Garner et al. 2016 New Phytologist. Haploid samples are assumed.
 
+Each gene region is converted into a sites x samples genotype matrix and the
+pairwise differences are calculated with matrix products, so NumPy is
+required.
+
+If a population map is given (-P parameter) pi is calculated for populations
+instead of sample pairs. The population map contains two columns: sample name
+and population name. Samples missing from the map are omitted. Output rows
+named popA/popA then contain the mean pi within population popA and rows
+named popA/popB the mean divergence (dxy) between populations popA and popB.
+These are calculated from the allele counts of each population, so the run
+time grows linearly with the number of samples. The -s parameter applies to
+the number of sites where at least one comparison could be made.
+
+Instead of bed file areas pi can be calculated in sliding windows along the
+genome (-w and -W parameters). The vcf file must then be sorted by position
+and it is read only once. Windows are named as scaffold_start_end using bed
+coordinates and are written in the order they appear in the vcf file. Windows
+without any sites passing the -m filter are omitted.
+
+Pairwise num and den values of each region can be saved to a directory (-c
+parameter). When new samples are added to the data set, a later run can be
+given this directory (-C parameter) together with a vcf file containing both
+the previous and the new samples. Only the comparisons involving new samples
+are then calculated and the stored values are used for the rest. Notice that
+the stored values are used as such, so sites passing the -m filter only
+because of the new samples are not added to the comparisons between previous
+samples. The updated values must be saved (-c) into a different directory
+than the one given with -C.
+
+By default the output is a table with a row for each comparison and a column
+for each region, which is written after all regions have been processed. Two
+streaming formats are also available (-f parameter), where the results of each
+region are written as soon as they are ready:
+long   - a table with columns region, comparison, num, den and pi
+matrix - a binary matrix of 32-bit floats (NaN for NA) with a row for each
+         region and a column for each comparison. Row and column names are
+         written to files with extensions .rows and .cols
+
 NOTICE that if the bed file (-b parameter) includes a non-standard fourth
 column (-g parameter) indicating the gene in question (created with gff_to_bed_maker.py) the
 contents of sequences with identical gene identifiers are concatenated!
@@ -70,6 +115,35 @@ parser.add_option('-s', '--min_number_of_available_sites_per_gene',
                   help='defines a minimum number of available sites required '
                        'for calculating pi',
                   type='int')
+parser.add_option('-S', '--sorted_input', help='input vcf file is sorted by '
+                                               'position (true/false). The vcf '
+                                               'file is then streamed instead '
+                                               'of reading it into memory '
+                                               '(def false)')
+parser.add_option('-p', '--processes', help='number of processes used for '
+                                            'calculating pi (def 1)',
+                  type='int')
+parser.add_option('-P', '--population_map', help='path to a file mapping '
+                                                 'samples to populations '
+                                                 '(optional)')
+parser.add_option('-w', '--window_size', help='calculate pi in sliding '
+                                              'windows of this size instead '
+                                              'of bed file areas (vcf file '
+                                              'must be sorted by position)',
+                  type='int')
+parser.add_option('-W', '--window_step', help='sliding window step size '
+                                              '(def window size)',
+                  type='int')
+parser.add_option('-c', '--save_counts', help='path to a directory for saving '
+                                              'pairwise num and den values '
+                                              '(optional)')
+parser.add_option('-C', '--previous_counts', help='path to a directory of '
+                                                  'saved num and den values. '
+                                                  'Only comparisons involving '
+                                                  'samples not found in it are '
+                                                  'calculated (optional)')
+parser.add_option('-f', '--output_format', help='output format: wide, long '
+                                                'or matrix (def wide)')
 args = parser.parse_args()[0]
 
 def pairwise(li):
@@ -81,128 +155,669 @@ def pairwise(li):
             j += 1
 
 def Pimatic(in_path, out_path, min_genotypes, bed_path,
-            min_sites_per_gene, bed_contains_gene_ids):
+            min_sites_per_gene, bed_contains_gene_ids, sorted_input,
+            processes, population_map_path, window_size, window_step,
+            save_counts_path, previous_counts_path, output_format):
     # find files matching the string in quotes; * is wildcard
     # using glob is helpful if your data is separated into multiple files, e.g.,
     #  by chromosome
     # have all the files match this structure, with the * being their unique
     # identifier
-    if bed_path is None:
-        print 'Error! bed file path is required! Try the original pimatic if you wish to not use bed file.'
-        sys.exit(0)
-    if bed_contains_gene_ids.lower() in ('t', 'true'):
+    if window_size is None:
+        if bed_path is None:
+            print 'Error! bed file path (-b) or window size (-w) is required!'
+            sys.exit(0)
+    else:
+        if bed_path is not None:
+            print 'Error! Both bed file (-b) and window size (-w) were given, ' \
+                  'only one of them can be used!'
+            sys.exit(0)
+        if window_step is None:
+            window_step = window_size
+        if window_size < 1 or window_step < 1:
+            print 'Error! Window size (-w) and step (-W) must be at least 1!'
+            sys.exit(0)
+    if bed_contains_gene_ids is None:
+        bed_contains_gene_ids = False
+    elif bed_contains_gene_ids.lower() in ('t', 'true'):
         bed_contains_gene_ids = True
-    elif bed_contains_gene_ids.lower() in ('f', 'false', None):
+    elif bed_contains_gene_ids.lower() in ('f', 'false'):
         bed_contains_gene_ids = False
-    gene_contents = split_vcf_to_genes(in_path, bed_path, bed_contains_gene_ids)
-    number_of_gene_regions = len(gene_contents)
-    print 'Read {0} gene regions.'.format(number_of_gene_regions)
+    if sorted_input is None or sorted_input.lower() in ('f', 'false'):
+        sorted_input = False
+    elif sorted_input.lower() in ('t', 'true'):
+        sorted_input = True
+    else:
+        print 'Error! Odd value for -S parameter. Allowed values are "true" and "false"!'
+        sys.exit(0)
+    if processes is None:
+        processes = 1
+    elif processes < 1:
+        print 'Error! Number of processes (-p) must be at least 1!'
+        sys.exit(0)
+    if min_genotypes is None:
+        min_genotypes = 0
+    if min_sites_per_gene is None:
+        min_sites_per_gene = 0
+    if output_format is None:
+        output_format = 'wide'
+    elif output_format.lower() not in ('wide', 'long', 'matrix'):
+        print 'Error! Odd value for -f parameter. Allowed values are "wide", ' \
+              '"long" and "matrix"!'
+        sys.exit(0)
+    output_format = output_format.lower()
+    if population_map_path is not None and (save_counts_path is not None or
+                                            previous_counts_path is not None):
+        print 'Error! Num and den values can not be saved (-c) or reused (-C) ' \
+              'with a population map (-P)!'
+        sys.exit(0)
+    if save_counts_path is not None and previous_counts_path is not None and \
+            os.path.realpath(save_counts_path) == os.path.realpath(previous_counts_path):
+        # The previous values are memory mapped while the new ones are written
+        print 'Error! Num and den values can not be saved (-c) into the ' \
+              'directory of the previous values (-C), use a new directory!'
+        sys.exit(0)
 
-    print '\nCalculating Pi...'
-    allowed_genotypes = '01'
+    sample_names = read_sample_names(in_path)
+    if population_map_path is None:
+        sample_order = sorted(range(len(sample_names)),
+                              key=lambda x: sample_names[x])
+        comparison_names = ['{0}/{1}'.format(sample_1, sample_2) for
+                            sample_1, sample_2 in
+                            pairwise([sample_names[x] for x in sample_order])]
+        population_matrix = None
+    else:
+        sample_populations = read_population_map(population_map_path,
+                                                 sample_names)
+        sample_order = sorted([x for x in range(len(sample_names)) if
+                               sample_names[x] in sample_populations],
+                              key=lambda x: sample_names[x])
+        populations = sorted(set(sample_populations.values()))
+        population_matrix = np.zeros((len(sample_order), len(populations)))
+        for i, x in enumerate(sample_order):
+            population = sample_populations[sample_names[x]]
+            population_matrix[i, populations.index(population)] = 1
+        rows, columns = np.triu_indices(len(populations))
+        comparison_names = ['{0}/{1}'.format(populations[population_1],
+                                             populations[population_2]) for
+                            population_1, population_2 in zip(rows, columns)]
+
+    if window_size is not None:
+        # Windows are summed from blocks that are shared by overlapping windows
+        block_size = gcd(window_size, window_step)
+        gene_regions = read_vcf_blocks(in_path, block_size)
+        number_of_gene_regions = None
+    elif sorted_input:
+        # Gene regions are read while pi is being calculated
+        gene_regions = sweep_vcf_and_bed(in_path, bed_path,
+                                         bed_contains_gene_ids)
+        number_of_gene_regions = None
+    else:
+        gene_contents = split_vcf_to_genes(in_path, bed_path,
+                                           bed_contains_gene_ids)
+        number_of_gene_regions = len(gene_contents)
+        print 'Read {0} gene regions.'.format(number_of_gene_regions)
+        gene_regions = ((gene_definition, gene_contents.pop(gene_definition))
+                        for gene_definition in sorted(gene_contents.keys()))
+
+    new_sample_pairs = None
+    if previous_counts_path is not None:
+        previous_counts = read_pair_counts(previous_counts_path)
+        if previous_counts['min_genotypes'] != min_genotypes:
+            print 'Warning! Previous num and den values were calculated with ' \
+                  '-m {0}, but -m {1} is now used!'.format(previous_counts['min_genotypes'],
+                                                          min_genotypes)
+        new_sample_pairs = find_new_sample_pairs([sample_names[x] for x in
+                                                  sample_order],
+                                                 previous_counts['samples'])
+        print '{0} new samples, calculating {1}/{2} comparisons.'.format(len(new_sample_pairs[0]),
+                                                                        len(new_sample_pairs[1]),
+                                                                        len(comparison_names))
+    if save_counts_path is not None:
+        counts_handles = open_pair_counts(save_counts_path,
+                                          [sample_names[x] for x in sample_order],
+                                          min_genotypes)
+
+    output_handles = open_output(out_path, output_format, comparison_names)
 
+    print '\nCalculating Pi...'
+    gene_region_results = calculate_gene_regions(gene_regions, processes,
+                                                 sample_order, min_genotypes,
+                                                 population_matrix,
+                                                 new_sample_pairs)
+    if window_size is not None:
+        gene_region_results = slide_windows(gene_region_results, window_size,
+                                            window_step, block_size)
     gene_region_number = 0
-    results = {}
-    out_handle_header = []
-    for gene_definition in sorted(gene_contents.keys()):
-        num = defaultdict(float)
-        den = defaultdict(float)
+    regions_done = set()
+    for gene_definition, num, den, sites in gene_region_results:
         gene_region_number += 1
-        print 'Calculating Pi for gene region number {0}/{1}'.format(gene_region_number,
-                                                                     number_of_gene_regions)
-        i = 0
-        genotype_list = gene_contents[gene_definition]
-        genotypes_examined = 0
-        too_few_genotypes = False
-        for line in genotype_list:
-            i += 1
-            if not line.strip(): continue
-            if line.startswith('##'): continue
-            if line.startswith('#'):
-                line = line.split('\t')
-                sample_names = line[9:]
-                continue
-            line = line.split('\t')
-            genotypes = dict(zip(sample_names, parse_genotypes(line[9:]))) #
-            if genotypes.values().count('0') + genotypes.values().count('1') < min_genotypes: continue
-            for sample_1, sample_2 in pairwise(sorted(genotypes.keys())):
-                if sample_1 == sample_2: continue
-                comparison_name = sample_1 + '/' + sample_2
-                comparison_name = comparison_name.replace('\n', '')
-                comparison_name = comparison_name.replace('\r', '')
-                sample_1_genotype, sample_2_genotype = genotypes[sample_1], genotypes[sample_2]
-                if sample_1_genotype in allowed_genotypes and sample_2_genotype in allowed_genotypes:
-                    if sample_1_genotype == sample_2_genotype:
-                        den[comparison_name]+=1 # if sequence is identical, only numerator is incremented
-                        if comparison_name not in num:
-                            num[comparison_name] = 0
-                    else: # if there is a SNP, den and num are both incremented
-                        den[comparison_name]+=1
-                        num[comparison_name]+=1
-                else: # make sure all comparisons are included in the output
-                    if comparison_name not in den:
-                        den[comparison_name] = 0
-                    if comparison_name not in num:
-                        num[comparison_name] = 0
-            genotypes_examined += 1
+        if window_size is not None:
+            print 'Calculating Pi for window number {0}'.format(gene_region_number)
+        elif number_of_gene_regions is None:
+            print 'Calculating Pi for gene region number {0}'.format(gene_region_number)
+        else:
+            print 'Calculating Pi for gene region number {0}/{1}'.format(gene_region_number,
+                                                                         number_of_gene_regions)
         print 'analyzing gene', gene_definition
 
-        assert len(num) == len(den) # for eachfile/chromosome, print file name
-        # and number of pairwise samplecomparisons, should be the same for numerator and denominator
+        # A gene is only included if at least one site passed the -m filter
+        if num is None:
+            print 'number of comparisons done', 0
+            continue
+        if new_sample_pairs is not None:
+            num, den = merge_pair_counts(num, den, gene_definition,
+                                         previous_counts, new_sample_pairs)
+            sites = den
         print 'number of comparisons done', len(num)
-        if len(num) != 0:
-            out_handle_header.append(gene_definition)
-        for comparison_name in num:
-            #Store Pi into results
-            if den[comparison_name] < min_sites_per_gene:
-                try:
-                    results[comparison_name].append('NA')
-                except KeyError:
-                    results[comparison_name] = ['NA']
-            else:
-                try:
-                    results[comparison_name].append(num[comparison_name] / den[comparison_name])
-                except KeyError:
-                    results[comparison_name] = [(num[comparison_name] / den[comparison_name])]
-            #print comparison_name, len(results[comparison_name])
-            #raw_input('enter')
-    out_handle = open(out_path, 'w')
-    #Output file header line contains gene positional info:
-    #out_handle.write('\t{0}\n'.format('\t'.join(gene_contents.keys())))
-    out_handle.write('\t{0}\n'.format('\t'.join(out_handle_header)))
-    for comparison_name in sorted(results.keys()):
-        print comparison_name
-        out_handle.write('{0}\t{1}\n'.format(comparison_name,
-                                             '\t'.join(map(str, results[comparison_name]))))
+        if save_counts_path is not None:
+            write_pair_counts(counts_handles, gene_definition, num, den)
+        pi = np.empty(len(num))
+        pi.fill(np.nan)
+        available = (sites >= min_sites_per_gene) & (den > 0)
+        pi[available] = num[available] / den[available].astype(np.float64)
+        write_output(output_handles, gene_definition, num, den, pi)
+        regions_done.add(gene_definition)
+    if save_counts_path is not None:
+        close_pair_counts(counts_handles)
+    if new_sample_pairs is not None:
+        missing_regions = set(previous_counts['regions']) - regions_done
+        if missing_regions:
+            print 'Warning! {0} regions of the previous num and den values ' \
+                  'were not found in this run.'.format(len(missing_regions))
+    # Gene regions are written in sorted order and windows in vcf order
+    close_output(output_handles, sort_regions=window_size is None)
+
+def open_output(out_path, output_format, comparison_names):
+    """Opens the output files and returns the handles used by
+    write_output() and close_output()"""
+    try:
+        out_handle = open(out_path, 'wb' if output_format == 'matrix' else 'w')
+    except IOError as ex:
+        print 'Error! Unable to create output file, reason: {0}'.format(str(ex))
+        sys.exit(0)
+    output_handles = {'format': output_format,
+                      'out': out_handle,
+                      'comparisons': comparison_names}
+    if output_format == 'wide':
+        output_handles['results'] = {}
+        output_handles['regions'] = []
+    elif output_format == 'long':
+        out_handle.write('region\tcomparison\tnum\tden\tpi\n')
+    elif output_format == 'matrix':
+        cols_handle = open(out_path + '.cols', 'w')
+        for comparison_name in comparison_names:
+            cols_handle.write('{0}\n'.format(comparison_name))
+        cols_handle.close()
+        output_handles['rows'] = open(out_path + '.rows', 'w')
+    return output_handles
+
+def write_output(output_handles, region, num, den, pi):
+    """Writes the results of a region. pi is NaN for NA values."""
+    if output_handles['format'] == 'wide':
+        # Kept in memory, since the table is written by columns
+        output_handles['results'][region] = pi
+        output_handles['regions'].append(region)
+    elif output_handles['format'] == 'long':
+        out_handle = output_handles['out']
+        for comparison_name, n, d, p in zip(output_handles['comparisons'],
+                                            num.tolist(), den.tolist(),
+                                            pi.tolist()):
+            out_handle.write('{0}\t{1}\t{2}\t{3}\t{4}\n'.format(region,
+                                                             comparison_name,
+                                                             n, d,
+                                                             'NA' if p != p else p))
+    elif output_handles['format'] == 'matrix':
+        pi.astype(np.float32).tofile(output_handles['out'])
+        output_handles['rows'].write('{0}\n'.format(region))
+
+def close_output(output_handles, sort_regions):
+    """Writes the wide output table (regions sorted by name if
+    sort_regions) and closes the output files"""
+    out_handle = output_handles['out']
+    if output_handles['format'] == 'wide':
+        results = output_handles['results']
+        comparison_names = output_handles['comparisons']
+        #Output file header line contains gene positional info:
+        if sort_regions:
+            out_handle_header = sorted(results.keys())
+        else:
+            out_handle_header = output_handles['regions']
+        out_handle.write('\t{0}\n'.format('\t'.join(out_handle_header)))
+        if results:
+            # comparisons x regions
+            pi_table = np.column_stack([results.pop(region) for region in
+                                        out_handle_header])
+            for i in sorted(range(len(comparison_names)),
+                            key=lambda x: comparison_names[x]):
+                out_handle.write('{0}\t{1}\n'.format(comparison_names[i],
+                                                     '\t'.join(['NA' if p != p else str(p)
+                                                                for p in pi_table[i].tolist()])))
+    elif output_handles['format'] == 'matrix':
+        output_handles['rows'].close()
     out_handle.close()
 
 def parse_genotypes(gt_fields):
     return [gt.split(':')[0] for gt in gt_fields]
 
-def split_vcf_to_genes(vcf_path, bed_path, bed_contains_gene_ids):
-    #Read in the vcf file
+GENOTYPE_CODES = {'0': 0, '1': 1}
+
+def genotype_matrix(record_lines, sample_order):
+    """Converts vcf lines into a sites x samples genotype matrix.
+
+    Reference genotypes are coded as 0 and alternative genotypes as 1. Missing
+    and any other genotypes are coded as -1. Columns are ordered according to
+    sample_order.
+    """
+    rows = []
+    for line in record_lines:
+        gt_fields = parse_genotypes(line.rstrip('\r\n').split('\t')[9:])
+        rows.append([GENOTYPE_CODES.get(gt, -1) for gt in gt_fields])
+    if not rows:
+        return np.zeros((0, len(sample_order)), dtype=np.int8)
+    return np.array(rows, dtype=np.int8)[:, sample_order]
+
+def pairwise_differences(genotypes):
+    """Calculates the number of differing (num) and comparable (den) sites
+    for every sample pair of a genotype matrix.
+
+    The pairs are returned in the order produced by pairwise() for the matrix
+    columns.
+    """
+    alt = (genotypes == 1).astype(np.float64)
+    ref = (genotypes == 0).astype(np.float64)
+    valid = alt + ref
+    # Sites where sample 1 has the alternative and sample 2 the reference
+    # genotype, and vice versa
+    num = np.dot(alt.T, ref)
+    num += num.T
+    den = np.dot(valid.T, valid)
+    rows, columns = np.triu_indices(genotypes.shape[1], 1)
+    return num[rows, columns], den[rows, columns]
+
+def new_pair_differences(genotypes, new_sample_pairs):
+    """Calculates the num and den values of the sample pairs involving new
+    samples (see find_new_sample_pairs()). Only the new samples are compared
+    against all samples."""
+    new_columns, rows, columns = new_sample_pairs[:3]
+    alt = (genotypes == 1).astype(np.float64)
+    ref = (genotypes == 0).astype(np.float64)
+    valid = alt + ref
+    num = np.dot(alt[:, new_columns].T, ref) + np.dot(ref[:, new_columns].T, alt)
+    den = np.dot(valid[:, new_columns].T, valid)
+    return num[rows, columns], den[rows, columns]
+
+def find_new_sample_pairs(sample_names, previous_samples):
+    """Returns the information needed for calculating only the sample pairs
+    involving samples not in previous_samples.
+
+    sample_names must be sorted. Returns a tuple of: column indices of the new
+    samples, row (new sample) and column (any sample) indices of the new
+    pairs in the new_pair_differences() matrices and a boolean array telling
+    which of all pairwise() pairs involve new samples.
+    """
+    missing_samples = set(previous_samples) - set(sample_names)
+    if missing_samples:
+        print 'Error! {0} samples of the previous num and den values are not ' \
+              'found in the vcf file: {1}'.format(len(missing_samples),
+                                                  ', '.join(sorted(missing_samples)))
+        sys.exit(0)
+    previous_samples = set(previous_samples)
+    new_columns = np.array([x for x in range(len(sample_names)) if
+                            sample_names[x] not in previous_samples], dtype=int)
+    new_sample_index = np.zeros(len(sample_names), dtype=int)
+    new_sample_index[new_columns] = np.arange(len(new_columns))
+    is_new_sample = np.zeros(len(sample_names), dtype=bool)
+    is_new_sample[new_columns] = True
+    sample_1, sample_2 = np.triu_indices(len(sample_names), 1)
+    is_new_pair = is_new_sample[sample_1] | is_new_sample[sample_2]
+    sample_1, sample_2 = sample_1[is_new_pair], sample_2[is_new_pair]
+    # One of the samples of a new pair is always a new sample
+    rows = np.where(is_new_sample[sample_1], new_sample_index[sample_1],
+                    new_sample_index[sample_2])
+    columns = np.where(is_new_sample[sample_1], sample_2, sample_1)
+    return new_columns, rows, columns, is_new_pair
+
+def merge_pair_counts(num, den, region, previous_counts, new_sample_pairs):
+    """Combines the num and den values of new sample pairs with the
+    previous values of the region. Previous values missing from a region are
+    considered zero."""
+    is_new_pair = new_sample_pairs[3]
+    merged_num = np.zeros(len(is_new_pair), dtype=np.int64)
+    merged_den = np.zeros(len(is_new_pair), dtype=np.int64)
+    merged_num[is_new_pair] = num
+    merged_den[is_new_pair] = den
+    if region in previous_counts['regions']:
+        row = previous_counts['regions'][region]
+        merged_num[~is_new_pair] = previous_counts['num'][row]
+        merged_den[~is_new_pair] = previous_counts['den'][row]
+    return merged_num, merged_den
+
+def open_pair_counts(counts_path, sample_names, min_genotypes):
+    """Creates a directory for saving pairwise num and den values. Returns
+    the handles used by write_pair_counts().
+
+    The directory contains the sorted sample names (samples.txt), the -m
+    value (parameters.txt), region names (regions.txt) and num and den
+    values as 32-bit integers with one row of pairwise() pairs for each
+    region (num.bin and den.bin).
+    """
+    if not os.path.isdir(counts_path):
+        try:
+            os.mkdir(counts_path)
+        except OSError as ex:
+            print 'Error! Unable to create directory for num and den values, ' \
+                  'reason: {0}'.format(str(ex))
+            sys.exit(0)
+    out_handle = open(os.path.join(counts_path, 'samples.txt'), 'w')
+    for sample in sample_names:
+        out_handle.write('{0}\n'.format(sample))
+    out_handle.close()
+    out_handle = open(os.path.join(counts_path, 'parameters.txt'), 'w')
+    out_handle.write('min_genotypes\t{0}\n'.format(min_genotypes))
+    out_handle.close()
+    return {'regions': open(os.path.join(counts_path, 'regions.txt'), 'w'),
+            'num': open(os.path.join(counts_path, 'num.bin'), 'wb'),
+            'den': open(os.path.join(counts_path, 'den.bin'), 'wb')}
+
+def write_pair_counts(counts_handles, region, num, den):
+    counts_handles['regions'].write('{0}\n'.format(region))
+    np.asarray(num, dtype=np.int32).tofile(counts_handles['num'])
+    np.asarray(den, dtype=np.int32).tofile(counts_handles['den'])
+
+def close_pair_counts(counts_handles):
+    for handle in counts_handles.values():
+        handle.close()
+
+def read_pair_counts(counts_path):
+    """Reads a directory created by open_pair_counts(). Returns a dict with
+    the sample names, the row of each region and memory mapped num and den
+    matrices."""
+    print '\nReading previous num and den values...'
+    try:
+        samples = [line.strip() for line in
+                   open(os.path.join(counts_path, 'samples.txt')) if line.strip()]
+        regions = [line.rstrip('\r\n') for line in
+                   open(os.path.join(counts_path, 'regions.txt'))]
+        parameters = dict(line.strip().split('\t') for line in
+                          open(os.path.join(counts_path, 'parameters.txt'))
+                          if line.strip())
+    except IOError as ex:
+        print 'Error! Unable to read previous num and den values, reason: ' \
+              '{0}'.format(str(ex))
+        sys.exit(0)
+    number_of_pairs = len(samples) * (len(samples) - 1) // 2
+    previous_counts = {'samples': samples,
+                       'regions': dict((region, row) for row, region in
+                                       enumerate(regions)),
+                       'min_genotypes': int(parameters['min_genotypes'])}
+    for name in ('num', 'den'):
+        path = os.path.join(counts_path, name + '.bin')
+        if os.path.getsize(path) != len(regions) * number_of_pairs * 4:
+            print 'Error! Size of {0} does not match the number of samples ' \
+                  'and regions!'.format(path)
+            sys.exit(0)
+        if number_of_pairs and regions:
+            previous_counts[name] = np.memmap(path, dtype=np.int32, mode='r',
+                                              shape=(len(regions),
+                                                     number_of_pairs))
+        else:
+            previous_counts[name] = np.zeros((len(regions), number_of_pairs),
+                                             dtype=np.int32)
+    print 'Read {0} samples and {1} regions.'.format(len(samples), len(regions))
+    return previous_counts
+
+def population_differences(genotypes, population_matrix):
+    """Calculates the summed pairwise differences (num), comparisons (den)
+    and the number of sites with at least one comparison (sites) within and
+    between populations from the allele counts of each population.
+
+    population_matrix is a samples x populations matrix indicating the
+    population of each sample. Comparisons are returned in the order of
+    numpy.triu_indices() for the populations, so that comparisons within
+    populations are on the diagonal. num and den equal the sums of the
+    pairwise_differences() values over the sample pairs of each comparison.
+    """
+    alt = np.dot((genotypes == 1).astype(np.float64), population_matrix)
+    valid = np.dot((genotypes >= 0).astype(np.float64), population_matrix)
+    ref = valid - alt
+    # Between populations: alt x ref + ref x alt and all valid pairs.
+    # On the diagonal these count each within population pair twice and den
+    # also includes the comparisons of samples with themselves.
+    num = np.dot(alt.T, ref)
+    num += num.T
+    den = np.dot(valid.T, valid)
+    sites = np.dot((valid > 0).T.astype(np.float64),
+                   (valid > 0).astype(np.float64))
+    diagonal = np.diag_indices(population_matrix.shape[1])
+    num[diagonal] /= 2
+    den[diagonal] = (den[diagonal] - valid.sum(axis=0)) / 2
+    sites[diagonal] = (valid > 1).sum(axis=0)
+    rows, columns = np.triu_indices(population_matrix.shape[1])
+    return num[rows, columns], den[rows, columns], sites[rows, columns]
+
+def calculate_gene_region(gene_definition, record_lines, sample_order,
+                          min_genotypes, population_matrix, new_sample_pairs):
+    """Returns the gene definition and the num, den and sites arrays of a
+    gene region. The arrays are None if no comparisons could be made.
+
+    Pairwise comparisons are calculated if population_matrix is None, in
+    which case the sites array is the den array. If new_sample_pairs is given
+    only the pairs involving new samples are calculated.
+    """
+    genotypes = genotype_matrix(record_lines, sample_order)
+    genotypes = genotypes[(genotypes >= 0).sum(axis=1) >= min_genotypes]
+    if population_matrix is not None:
+        if not len(genotypes) or not population_matrix.shape[1]:
+            return gene_definition, None, None, None
+        num, den, sites = population_differences(genotypes, population_matrix)
+        return gene_definition, num.astype(np.int64), den.astype(np.int64), \
+               sites.astype(np.int64)
+    if not len(genotypes) or len(sample_order) < 2:
+        return gene_definition, None, None, None
+    if new_sample_pairs is not None:
+        num, den = new_pair_differences(genotypes, new_sample_pairs)
+    else:
+        num, den = pairwise_differences(genotypes)
+    den = den.astype(np.int32)
+    return gene_definition, num.astype(np.int32), den, den
+
+def calculate_gene_regions(gene_regions, processes, sample_order,
+                           min_genotypes, population_matrix, new_sample_pairs):
+    """Yields the results of calculate_gene_region() in the order of
+    gene_regions.
+
+    If more than one process is used the gene regions are distributed to a
+    process pool. Only a limited number of gene regions are submitted to the
+    pool at a time so that streamed gene regions are not all read into
+    memory.
+    """
+    if processes == 1:
+        for gene_definition, record_lines in gene_regions:
+            yield calculate_gene_region(gene_definition, record_lines,
+                                        sample_order, min_genotypes,
+                                        population_matrix, new_sample_pairs)
+        return
+    # The arguments shared by all gene regions (including the potentially
+    # large new_sample_pairs arrays) are sent to each process only once
+    pool = multiprocessing.Pool(processes, initializer=init_gene_region_worker,
+                                initargs=((sample_order, min_genotypes,
+                                           population_matrix,
+                                           new_sample_pairs),))
+    try:
+        pending_results = deque()
+        for gene_definition, record_lines in gene_regions:
+            pending_results.append(pool.apply_async(calculate_worker_gene_region,
+                                                    (gene_definition,
+                                                     record_lines)))
+            if len(pending_results) >= processes * 4:
+                yield pending_results.popleft().get()
+        while pending_results:
+            yield pending_results.popleft().get()
+    finally:
+        pool.terminate()
+        pool.join()
+
+# Arguments of calculate_gene_region() shared by all gene regions of a
+# worker process, set by init_gene_region_worker()
+worker_arguments = None
+
+def init_gene_region_worker(arguments):
+    global worker_arguments
+    worker_arguments = arguments
+
+def calculate_worker_gene_region(gene_definition, record_lines):
+    return calculate_gene_region(gene_definition, record_lines,
+                                 *worker_arguments)
+
+def read_vcf_blocks(vcf_path, block_size):
+    """Yields ((scaffold, block number), vcf lines) of each block of
+    block_size base pairs containing vcf records. Block n contains the
+    positions n*block_size+1 ... (n+1)*block_size. The vcf file must be
+    sorted by position."""
     print '\nReading vcf file...'
     in_handle = open(vcf_path)
-    header_lines = []
-    genotype_lines = {}
+    finished_scaffolds = set()
+    current_block = None
+    block_lines = []
+    prev_position = 0
+    i = 0
     for line in in_handle:
-        if line.startswith('#'):
-            header_lines.append(line)
-            continue
+        i += 1
+        if line.startswith('#'): continue
         line = line.strip()
         if not line: continue
-        split_line = line.split()
-        genotype_lines[(split_line[0], split_line[1])] = line
+        split_line = line.split('\t', 2)
+        scaffold = split_line[0]
+        position = int(split_line[1])
+        if current_block is None or scaffold != current_block[0]:
+            if scaffold in finished_scaffolds:
+                print 'Error! The vcf file is not sorted, scaffold {0} ' \
+                      'found again on line {1}!'.format(scaffold, i)
+                sys.exit(0)
+            if current_block is not None:
+                finished_scaffolds.add(current_block[0])
+            prev_position = 0
+        if position < prev_position:
+            print 'Error! The vcf file is not sorted by position on line ' \
+                  '{0}!'.format(i)
+            sys.exit(0)
+        prev_position = position
+        block = (scaffold, (position - 1) // block_size)
+        if block != current_block:
+            if block_lines:
+                yield current_block, block_lines
+            current_block = block
+            block_lines = []
+        block_lines.append(line)
     in_handle.close()
+    if block_lines:
+        yield current_block, block_lines
+
+def slide_windows(block_results, window_size, window_step, block_size):
+    """Sums the block results of calculate_gene_regions() into sliding
+    windows and yields (window name, num, den, sites) for each window
+    containing results.
 
+    The blocks must be in the order of read_vcf_blocks(). The window sums
+    are updated by adding the blocks entering and subtracting the blocks
+    leaving the window as it slides.
+    """
+    window_blocks = window_size // block_size
+    step_blocks = window_step // block_size
+    current_scaffold = None
+    window = 0
+    window_contents = deque()
+    window_sums = []
+    # The last item flushes the remaining windows
+    for (scaffold, block), num, den, sites in chain(block_results,
+                                                    [((None, None), None,
+                                                      None, None)]):
+        if num is None and scaffold is not None: continue
+        # Yield the windows ending before this block, or all remaining
+        # windows if the scaffold changes
+        while window_contents and (scaffold != current_scaffold or
+                                   window * step_blocks + window_blocks <= block):
+            window_start = window * window_step
+            yield ('{0}_{1}_{2}'.format(current_scaffold, window_start,
+                                        window_start + window_size),
+                   window_sums[0].copy(), window_sums[1].copy(),
+                   window_sums[2].copy())
+            window += 1
+            while window_contents and \
+                    window_contents[0][0] < window * step_blocks:
+                for window_sum, block_sum in zip(window_sums,
+                                                 window_contents.popleft()[1:]):
+                    window_sum -= block_sum
+        if scaffold is None:
+            break
+        if scaffold != current_scaffold:
+            current_scaffold = scaffold
+            window = 0
+        if not window_contents:
+            # Skip to the first window containing this block
+            window = max(window, -(-(block + 1 - window_blocks) // step_blocks))
+            if window * step_blocks > block:
+                # The block is between two windows
+                continue
+            window_sums = [np.zeros(len(num), dtype=np.int64) for i in range(3)]
+        window_contents.append((block, num, den, sites))
+        for window_sum, block_sum in zip(window_sums, (num, den, sites)):
+            window_sum += block_sum
+
+def read_sample_names(vcf_path):
+    """Returns the sample names found on the header line of a vcf file"""
+    in_handle = open(vcf_path)
+    for line in in_handle:
+        if line.startswith('##'): continue
+        if line.startswith('#'):
+            in_handle.close()
+            return [name.strip() for name in line.split('\t')[9:]]
+        break
+    in_handle.close()
+    print 'Error! Header line containing the sample names was not found in ' \
+          'the vcf file!'
+    sys.exit(0)
 
-    #Read bed file and select gene areas from vcf file
+def read_population_map(population_map_path, sample_names):
+    """Returns a dict with the population of each sample"""
+    print '\nReading population map...'
+    sample_populations = {}
+    in_handle = open(population_map_path)
+    i = 0
+    for line in in_handle:
+        i += 1
+        line = line.strip()
+        if not line: continue
+        if line.startswith('#'): continue
+        line = line.split()
+        if len(line) != 2:
+            print 'Error! Two columns (sample and population) expected on ' \
+                  'line {0} of the population map, {1} found!'.format(i, len(line))
+            sys.exit(0)
+        sample_populations[line[0]] = line[1]
+    in_handle.close()
+    missing_samples = set(sample_populations) - set(sample_names)
+    if missing_samples:
+        print 'Warning! {0} samples of the population map are not found in ' \
+              'the vcf file: {1}'.format(len(missing_samples),
+                                         ', '.join(sorted(missing_samples)))
+        for sample in missing_samples:
+            sample_populations.pop(sample)
+    if not sample_populations:
+        print 'Error! None of the samples in the population map were found ' \
+              'in the vcf file!'
+        sys.exit(0)
+    print 'Read {0} samples in {1} populations.'.format(len(sample_populations),
+                                                       len(set(sample_populations.values())))
+    return sample_populations
+
+def read_bed_file(bed_path, bed_contains_gene_ids):
+    """Returns the bed file areas as (scaffold, start, end, gene_definition)
+    tuples in the order they appear in the file"""
     print '\nReading bed file...'
-    gene_contents = {}
+    bed_areas = []
     in_handle = open(bed_path)
-    total_bed_area_size = 0
-    sites_not_found = 0
-    empty_gene_areas = 0
     first_line = True
     i = 0
     for line in in_handle:
@@ -214,33 +829,191 @@ def split_vcf_to_genes(vcf_path, bed_path, bed_contains_gene_ids):
                     line.lower().startswith('track'):
                 continue
             first_line = False
-            
+
         line = line.strip()
         if not line: continue
         line = line.split('\t')
         #If bed file line has four columns the last column is expected to contain gene name added by the gff_to_bed_maker.py
         if len(line) < 4 and bed_contains_gene_ids:
-            print 'Error! Less than four columns found on line {i}, but four ' \
+            print 'Error! Less than four columns found on line {0}, but four ' \
                   'expected as -g parameter was set True!'.format(i)
             sys.exit(0)
         if bed_contains_gene_ids:
             gene_definition = line[3]
         else:
             gene_definition = '_'.join(line) #ie. scaffold_startpos_endpos(_genename)
-        gene_contents[gene_definition] = []
-        total_bed_area_size += int(line[2]) - int(line[1])
-        for position in xrange(int(line[1]), int(line[2])):
+        bed_areas.append((line[0], int(line[1]), int(line[2]), gene_definition))
+    in_handle.close()
+    return bed_areas
+
+def split_vcf_to_genes(vcf_path, bed_path, bed_contains_gene_ids):
+    #Read in the vcf file
+    print '\nReading vcf file...'
+    in_handle = open(vcf_path)
+    genotype_lines = {}
+    for line in in_handle:
+        if line.startswith('#'):
+            continue
+        line = line.strip()
+        if not line: continue
+        split_line = line.split()
+        genotype_lines[(split_line[0], split_line[1])] = line
+    in_handle.close()
+
+
+    #Read bed file and select gene areas from vcf file. Areas sharing a gene
+    #identifier are concatenated, sites covered by several areas are used once
+    gene_contents = {}
+    gene_sites = {}
+    total_bed_area_size = 0
+    sites_not_found = 0
+    empty_gene_areas = 0
+    for scaffold, start, end, gene_definition in read_bed_file(bed_path,
+                                                               bed_contains_gene_ids):
+        gene_contents.setdefault(gene_definition, [])
+        gene_sites.setdefault(gene_definition, set())
+        total_bed_area_size += end - start
+        area_sites = 0
+        for position in xrange(start, end):
             try:
-                gene_contents[gene_definition].append(genotype_lines[(line[0], str(position+1))])
+                line = genotype_lines[(scaffold, str(position+1))]
             except KeyError:
                 sites_not_found += 1
-        if len(gene_contents[gene_definition]) == 0:
+                continue
+            area_sites += 1
+            if (scaffold, position) not in gene_sites[gene_definition]:
+                gene_sites[gene_definition].add((scaffold, position))
+                gene_contents[gene_definition].append(line)
+        if not area_sites:
             empty_gene_areas += 1
+    for gene_definition in gene_contents.keys():
+        if not gene_contents[gene_definition]:
             gene_contents.pop(gene_definition)
-        else:
-            gene_contents[gene_definition] = header_lines + gene_contents[gene_definition]
 
+    print_bed_coverage(total_bed_area_size, sites_not_found, empty_gene_areas)
+    return gene_contents
+
+def sweep_vcf_and_bed(vcf_path, bed_path, bed_contains_gene_ids):
+    """Yields (gene_definition, vcf lines) of each gene region as soon as it
+    has been read from a position sorted vcf file.
+
+    The vcf file is streamed once and only the lines of the gene regions
+    overlapping the current position are kept in memory. The bed file does
+    not need to be sorted. Areas sharing a gene identifier are concatenated.
+    """
+    bed_areas = read_bed_file(bed_path, bed_contains_gene_ids)
+    # Areas of each scaffold sorted by start position, reversed for popping
+    scaffold_areas = {}
+    gene_area_counts = defaultdict(int)
+    total_bed_area_size = 0
+    for area_index, (scaffold, start, end, gene_definition) in enumerate(bed_areas):
+        scaffold_areas.setdefault(scaffold, []).append((start, end, area_index,
+                                                         gene_definition))
+        gene_area_counts[gene_definition] += 1
+        total_bed_area_size += end - start
+    for scaffold in scaffold_areas:
+        scaffold_areas[scaffold].sort(reverse=True)
+    print 'Read {0} gene regions.'.format(len(gene_area_counts))
+
+    gene_lines = defaultdict(list)
+    sites_found = [0]
+    empty_gene_areas = [0]
+
+    def close_area(area_end, area_index, gene_definition, area_sites):
+        """Returns the gene contents if this was the last area of the gene"""
+        sites_found[0] += area_sites
+        if not area_sites:
+            empty_gene_areas[0] += 1
+        gene_area_counts[gene_definition] -= 1
+        if gene_area_counts[gene_definition] == 0:
+            return gene_lines.pop(gene_definition, None)
+        return None
+
+    print '\nReading vcf file...'
+    in_handle = open(vcf_path)
+    finished_scaffolds = set()
+    current_scaffold = None
+    prev_position = 0
+    pending_areas = []
+    # Heap of [end, area_index, gene_definition, sites in area]
+    active_areas = []
+    i = 0
+    for line in in_handle:
+        i += 1
+        if line.startswith('#'): continue
+        line = line.strip()
+        if not line: continue
+        split_line = line.split('\t', 2)
+        scaffold = split_line[0]
+        position = int(split_line[1])
+        if scaffold != current_scaffold:
+            for area in active_areas:
+                lines = close_area(*area)
+                if lines:
+                    yield area[2], lines
+            for start, end, area_index, gene_definition in reversed(pending_areas):
+                lines = close_area(end, area_index, gene_definition, 0)
+                if lines:
+                    yield gene_definition, lines
+            if scaffold in finished_scaffolds:
+                print 'Error! The vcf file is not sorted, scaffold {0} ' \
+                      'found again on line {1}!'.format(scaffold, i)
+                sys.exit(0)
+            finished_scaffolds.add(current_scaffold)
+            current_scaffold = scaffold
+            prev_position = 0
+            pending_areas = scaffold_areas.pop(scaffold, [])
+            active_areas = []
+        if position < prev_position:
+            print 'Error! The vcf file is not sorted by position on line ' \
+                  '{0}!'.format(i)
+            sys.exit(0)
+        prev_position = position
+
+        # Close the areas ending before this position and open the areas
+        # containing it (bed areas are zero-based and half-open)
+        while active_areas and active_areas[0][0] < position:
+            area = heapq.heappop(active_areas)
+            lines = close_area(*area)
+            if lines:
+                yield area[2], lines
+        while pending_areas and pending_areas[-1][0] < position:
+            start, end, area_index, gene_definition = pending_areas.pop()
+            if end < position:
+                lines = close_area(end, area_index, gene_definition, 0)
+                if lines:
+                    yield gene_definition, lines
+            else:
+                heapq.heappush(active_areas, [end, area_index,
+                                              gene_definition, 0])
+        genes_found = set()
+        for area in active_areas:
+            area[3] += 1
+            if area[2] not in genes_found:
+                gene_lines[area[2]].append(line)
+                genes_found.add(area[2])
     in_handle.close()
+
+    # Close the areas of the last scaffold and of scaffolds not in vcf file
+    for area in active_areas:
+        lines = close_area(*area)
+        if lines:
+            yield area[2], lines
+    for start, end, area_index, gene_definition in reversed(pending_areas):
+        lines = close_area(end, area_index, gene_definition, 0)
+        if lines:
+            yield gene_definition, lines
+    for scaffold in scaffold_areas:
+        for start, end, area_index, gene_definition in scaffold_areas[scaffold]:
+            lines = close_area(end, area_index, gene_definition, 0)
+            if lines:
+                yield gene_definition, lines
+
+    print_bed_coverage(total_bed_area_size,
+                       total_bed_area_size - sites_found[0],
+                       empty_gene_areas[0])
+
+def print_bed_coverage(total_bed_area_size, sites_not_found, empty_gene_areas):
     if sites_not_found == total_bed_area_size:
         print 'Error! No sites covered by bed file found in vcf-file!'
         sys.exit(0)
@@ -250,7 +1023,9 @@ def split_vcf_to_genes(vcf_path, bed_path, bed_contains_gene_ids):
               'not found in the vcf file!'.format(sites_not_found,
                                                   total_bed_area_size,
                                                   float(sites_not_found)/total_bed_area_size*100)
-    return gene_contents
 
 Pimatic(args.input, args.output_file, args.min_genotypes, args.bed,
-        args.min_number_of_available_sites_per_gene, args.bed_contains_gene_ids)
\ No newline at end of file
+        args.min_number_of_available_sites_per_gene, args.bed_contains_gene_ids,
+        args.sorted_input, args.processes, args.population_map,
+        args.window_size, args.window_step, args.save_counts,
+        args.previous_counts, args.output_format)
@@ -1,3 +1,4 @@
+# -*- coding: utf-8 -*-
 '''
 Copyright © 2017 Jaakko Tyrmi. All Rights Reserved.
 
@@ -27,12 +28,14 @@ POSSIBILITY OF SUCH DAMAGE.
 '''
 
 
+import multiprocessing
 import optparse
 import os
 import shutil
+import subprocess
 import sys
 
-VERSION = '17.01.30'
+VERSION = '26.10.18'
 NAME = 'bayenv2_SNPSFILE_breaker'
 descr = """
 This program breaks a bayenv2 SNPSFILE into separate SNPFILEs containing
@@ -50,6 +53,37 @@ directory to allow parallelized run. The files will be renamed to
 MATRIXFILE.txt and ENVIRONFILE.txt for easy parallelization with
 PipelineMaster1000. Refer to bayenv2 manual on how to generate ENVIRONFILE and
 MATRIXFILE.
+
+Alternatively the SNPSFILE can be created directly from the vcf file by giving
+a population map (-P) instead of the SNPSFILE (-i). The population map has two
+columns: sample name and population. The populations are written in the
+order of their first appearance in the population map, which must match the
+order of ENVIRONFILE and MATRIXFILE. The order is also saved to
+"populations.txt" of the output directory. The allele counts of all sites are
+written, including monomorphic ones. Multiallelic sites are skipped, since
+bayenv2 expects biallelic SNPs.
+
+With a large number of SNPs the per SNP directories add up to millions of
+files. The -k option writes -k SNPs into each output directory instead
+(shard). Each shard contains a single SNPSFILE named after the shard
+directory. The bayenv2 executable, ENVIRONFILE and MATRIXFILE are copied
+only once into a "shared_files" directory and hardlinked (or symlinked if
+hardlinks are not supported) into each shard. A file named "manifest.txt"
+lists the shard, the SNP line number within the shard SNPSFILE and the SNP
+name (CHROM_POS of the vcf file, or running number if -v is not given).
+
+The SNPs can also be run locally with -r true. In this mode the SNP
+directories (or shards) of the output directory (-o) are processed with -p
+parallel processes. Bayenv2 is run once for each SNP in the directory of the
+SNP using the copied files, with the arguments given with -a (e.g.
+-a "-p 12 -n 3 -k 100000 -r 1234"). The input, MATRIXFILE, ENVIRONFILE,
+output and -t arguments are added by this program. The Bayes factors of a
+directory are saved to "bayenv2_results.txt" in that directory once all of
+its SNPs are done, and the results are collected into the file
+"bayenv2_combined_results.txt" of the output directory as the directories
+finish, each line starting with the SNP name. Directories that already have
+results are not run again, so an interrupted run can be continued by running
+the same command again.
 """
 
 print '\nRunning {0} v.{1}'.format(NAME, VERSION)
@@ -62,82 +96,454 @@ parser.add_option('-v', '--vcf_file', help='original vcf file of which '
 parser.add_option('-b', '--bayenv2_executable', help='path to bayenv2 executable file')
 parser.add_option('-e', '--environfile', help='path to environfile')
 parser.add_option('-m', '--matrixfile', help='path to matrixfile')
+parser.add_option('-P', '--population_map', help='path to a file mapping '
+                                                 'samples to populations, '
+                                                 'used to convert the vcf '
+                                                 'file (-v) into SNPSFILEs')
+parser.add_option('-k', '--snps_per_dir', help='number of SNPs per output '
+                                               'directory (def 1, i.e. a '
+                                               'directory per SNP)',
+                  type='int')
+parser.add_option('-r', '--run', help='run bayenv2 for the SNPs in the output '
+                                      'directory instead of breaking a '
+                                      'SNPSFILE (true/false, def false)')
+parser.add_option('-p', '--processes', help='number of parallel bayenv2 '
+                                            'processes with -r (def 1)',
+                  type='int')
+parser.add_option('-a', '--bayenv2_arguments', help='additional arguments for '
+                                                    'bayenv2 with -r')
 
 args = parser.parse_args()[0]
 
 
-def bayenv2_SNPSFILE_breaker(in_file_path, out_dir_path, vcf_file_path, bayenv2_executable, environfile, matrixfile):
+def bayenv2_SNPSFILE_breaker(in_file_path, out_dir_path, vcf_file_path,
+                             bayenv2_executable, environfile, matrixfile,
+                             snps_per_dir, population_map_path):
     print 'Using parameters:'
     print 'SNPSFILE', in_file_path
     print 'Output directory', out_dir_path
     print 'Bayenv2 executable', bayenv2_executable
     print 'Vcf file', vcf_file_path
+    print 'Population map', population_map_path
     print 'ENVIRONFILE', environfile
     print 'MATRIXFILE', matrixfile
+    print 'SNPs per directory', snps_per_dir
+    if snps_per_dir is not None and snps_per_dir < 1:
+        print 'ERROR! Number of SNPs per directory (-k) must be at least 1!'
+        sys.exit(0)
+    if population_map_path is not None:
+        if vcf_file_path is None:
+            print 'ERROR! Vcf file (-v) is required with a population map!'
+            sys.exit(0)
+        convert_vcf(vcf_file_path, population_map_path, out_dir_path,
+                    bayenv2_executable, environfile, matrixfile, snps_per_dir)
+        return
 
     if vcf_file_path is not None:
-        print 'Reading vcf file...'
-        in_handle = open(vcf_file_path)
-        i = 0
-        vcf_positions = []
-        for line in in_handle:
-            i += 1
-            line = line.strip()
-            if not line: continue
-            if line.startswith('#'): continue
-            line = line.split('\t')
-            if len(line) < 9:
-                print 'ERROR! Vcf file format should contain at least 9 columns!'
-                print 'Line {0} had {1} columns!'.format(i, len(line))
+        site_names = read_vcf_site_names(vcf_file_path)
+
+    print '\nBreaking SNPSFILE into parts...'
+    writer = snp_writer(out_dir_path, snps_per_dir, bayenv2_executable,
+                        environfile, matrixfile)
+    for snp_number, variants in enumerate(read_snpsfile(in_file_path), 1):
+        if vcf_file_path is not None:
+            try:
+                snp_name = next(site_names)
+            except StopIteration:
+                print 'ERROR! The vcf file has fewer variants ({0}) than the input SNPSFILE!'.format(snp_number-1)
                 sys.exit(0)
-            vcf_positions.append('{0}_{1}'.format(line[0], line[1]))
+        else:
+            snp_name = str(snp_number).rjust(10, '0')
+        writer.add_snp(snp_name, variants)
+    writer.close()
+
+    if vcf_file_path is not None:
+        remaining_sites = sum(1 for snp_name in site_names)
+        if remaining_sites:
+            print 'ERROR! The vcf file has more variants ({0}) than the input SNPSFILE ({1})!'.format(writer.snps_written + remaining_sites, writer.snps_written)
+            print 'The names of output files are wrong!'
+            sys.exit(0)
+    print 'Done. Created {0} output SNPFILEs!'.format(writer.snps_written)
+
+    print '\nProgram run successful!'
+
+
+def run_bayenv2(out_dir_path, bayenv2_executable, processes, bayenv2_arguments):
+    print 'Using parameters:'
+    print 'Output directory', out_dir_path
+    print 'Bayenv2 executable', bayenv2_executable
+    print 'Processes', processes
+    print 'Bayenv2 arguments', bayenv2_arguments
+    if bayenv2_executable is None:
+        print 'ERROR! Bayenv2 executable (-b) is required to run bayenv2!'
+        sys.exit(0)
+    if processes is None:
+        processes = 1
+    elif processes < 1:
+        print 'ERROR! Number of processes (-p) must be at least 1!'
+        sys.exit(0)
+    if bayenv2_arguments is None:
+        bayenv2_arguments = ''
+    bayenv2_command = ['./' + os.path.basename(bayenv2_executable)] + \
+                      bayenv2_arguments.split()
+
+    print '\nRunning bayenv2...'
+    out_handle = open(os.path.join(out_dir_path,
+                                   'bayenv2_combined_results.txt'), 'w')
+    tasks = []
+    units_done = 0
+    for dir_name, snp_names in read_snp_dirs(out_dir_path):
+        dir_path = os.path.join(out_dir_path, dir_name)
+        results_path = os.path.join(dir_path, 'bayenv2_results.txt')
+        if os.path.isfile(results_path):
+            # Completed on an earlier run
+            results_handle = open(results_path)
+            shutil.copyfileobj(results_handle, out_handle)
+            results_handle.close()
+            units_done += 1
+        else:
+            tasks.append((dir_path, snp_names, bayenv2_command))
+    if units_done:
+        print '{0} directories were already completed.'.format(units_done)
+
+    failed_units = 0
+    pool = multiprocessing.Pool(processes)
+    for dir_path, results, error in pool.imap_unordered(run_snp_dir, tasks):
+        if error is not None:
+            print 'ERROR! Bayenv2 run failed in {0}: {1}'.format(dir_path, error)
+            failed_units += 1
+            continue
+        out_handle.write(results)
+        out_handle.flush()
+        units_done += 1
+        if units_done % 1000 == 0:
+            print '{0} directories completed...'.format(units_done)
+    pool.close()
+    pool.join()
+    out_handle.close()
+    print 'Done. {0} directories completed, {1} failed.'.format(units_done,
+                                                              failed_units)
+    if failed_units:
+        print 'Failed directories will be run again if this command is repeated.'
+    else:
+        print '\nProgram run successful!'
+
+
+def read_snp_dirs(out_dir_path):
+    """Yields the name and the SNP names of each SNP directory or shard in
+    the output directory"""
+    manifest_path = os.path.join(out_dir_path, 'manifest.txt')
+    if os.path.isfile(manifest_path):
+        in_handle = open(manifest_path)
+        in_handle.readline()
+        shard_name = None
+        snp_names = []
+        for line in in_handle:
+            line = line.rstrip('\n').split('\t')
+            if line[0] != shard_name:
+                if snp_names:
+                    yield shard_name + '.SNPFILEDIR', snp_names
+                shard_name = line[0]
+                snp_names = []
+            snp_names.append(line[2])
+        if snp_names:
+            yield shard_name + '.SNPFILEDIR', snp_names
         in_handle.close()
-        print 'Done. Found {0} sites.'.format(len(vcf_positions))
+    else:
+        for dir_name in sorted(os.listdir(out_dir_path)):
+            if dir_name.startswith('bayenv2_input_') and \
+                    dir_name.endswith('.SNPFILEDIR'):
+                yield dir_name, [dir_name[len('bayenv2_input_'):-len('.SNPFILEDIR')]]
 
-    print '\nBreaking SNPSFILE into parts...'
-    in_handle = open(in_file_path)
+
+def run_snp_dir(task):
+    """Runs bayenv2 for each SNP of a SNP directory or shard. Returns the
+    directory path, the results labelled with SNP names and an error message
+    (None if the run succeeded)."""
+    dir_path, snp_names, bayenv2_command = task
+    snp_files = [file_name for file_name in os.listdir(dir_path) if
+                 file_name.endswith('.SNPFILE') or
+                 file_name.endswith('.SNPSFILE')]
+    snp_files = [file_name for file_name in snp_files if
+                 file_name != 'bayenv2_current.SNPFILE']
+    if len(snp_files) != 1:
+        return dir_path, None, 'expected one SNPFILE, found {0}'.format(len(snp_files))
+    output_path = os.path.join(dir_path, 'bayenv2_output.bf')
+    if os.path.exists(output_path):
+        os.remove(output_path)
+    current_path = os.path.join(dir_path, 'bayenv2_current.SNPFILE')
+    devnull = open(os.devnull, 'w')
+    for variants in read_snpsfile(os.path.join(dir_path, snp_files[0])):
+        # Bayenv2 reads a single SNP from its input file
+        current_handle = open(current_path, 'w')
+        current_handle.write(variants)
+        current_handle.close()
+        try:
+            return_code = subprocess.call(bayenv2_command +
+                                          ['-i', 'bayenv2_current.SNPFILE',
+                                           '-m', 'MATRIXFILE.txt',
+                                           '-e', 'ENVIRONFILE.txt',
+                                           '-o', 'bayenv2_output', '-t'],
+                                          cwd=dir_path, stdout=devnull,
+                                          stderr=devnull)
+        except OSError as ex:
+            devnull.close()
+            return dir_path, None, str(ex)
+        if return_code != 0:
+            devnull.close()
+            return dir_path, None, 'bayenv2 exited with code {0}'.format(return_code)
+    devnull.close()
+    os.remove(current_path)
+
+    # Each line of the output is the input file name followed by the Bayes
+    # factors of each environmental variable
+    bf_lines = []
+    if os.path.exists(output_path):
+        in_handle = open(output_path)
+        bf_lines = [line.split()[1:] for line in in_handle if line.strip()]
+        in_handle.close()
+        os.remove(output_path)
+    if len(bf_lines) != len(snp_names):
+        return dir_path, None, 'expected results for {0} SNPs, found {1}'.format(len(snp_names), len(bf_lines))
+    results = ''.join('{0}\t{1}\n'.format(snp_name, '\t'.join(bfs)) for
+                      snp_name, bfs in zip(snp_names, bf_lines))
+    # Write results under a temporary name so that interrupted writes are not
+    # mistaken for completed directories
+    results_path = os.path.join(dir_path, 'bayenv2_results.txt')
+    results_handle = open(results_path + '.tmp', 'w')
+    results_handle.write(results)
+    results_handle.close()
+    os.rename(results_path + '.tmp', results_path)
+    return dir_path, results, None
+
+
+def convert_vcf(vcf_file_path, population_map_path, out_dir_path,
+                bayenv2_executable, environfile, matrixfile, snps_per_dir):
+    """Writes the population allele counts of each vcf file site as SNPSFILEs
+    named by CHROM_POS"""
+    populations, sample_populations = read_population_map(population_map_path)
+    out_handle = open(os.path.join(out_dir_path, 'populations.txt'), 'w')
+    out_handle.write('\n'.join(populations) + '\n')
+    out_handle.close()
+
+    print '\nConverting vcf file into SNPSFILEs...'
+    writer = snp_writer(out_dir_path, snps_per_dir, bayenv2_executable,
+                        environfile, matrixfile)
+    in_handle = open(vcf_file_path)
+    # (column, population index) pairs of the mapped samples
+    sample_columns = None
+    multiallelic_sites = 0
     i = 0
+    for line in in_handle:
+        i += 1
+        line = line.strip()
+        if not line: continue
+        if line.startswith('##'): continue
+        line = line.split('\t')
+        if line[0] == '#CHROM':
+            sample_columns = [(column, populations.index(sample_populations[sample])) for
+                              column, sample in enumerate(line[9:], 9) if
+                              sample in sample_populations]
+            missing_samples = set(sample_populations) - set(line[9:])
+            if missing_samples:
+                print 'ERROR! {0} samples of the population map are not found ' \
+                      'in the vcf file: {1}'.format(len(missing_samples),
+                                                    ', '.join(sorted(missing_samples)))
+                sys.exit(0)
+            continue
+        if sample_columns is None:
+            print 'ERROR! Header line containing sample names was not found ' \
+                  'before the first variant!'
+            sys.exit(0)
+        if len(line) < 10:
+            print 'ERROR! Vcf file format should contain at least 10 columns!'
+            print 'Line {0} had {1} columns!'.format(i, len(line))
+            sys.exit(0)
+        if ',' in line[4]:
+            multiallelic_sites += 1
+            continue
+        try:
+            gt_index = line[8].split(':').index('GT')
+        except ValueError:
+            print 'ERROR! No GT field found on line {0}!'.format(i)
+            sys.exit(0)
+        ref_counts = [0]*len(populations)
+        alt_counts = [0]*len(populations)
+        for column, population in sample_columns:
+            genotype = line[column].split(':')
+            if len(genotype) <= gt_index: continue
+            for allele in genotype[gt_index].replace('|', '/').split('/'):
+                if allele == '0':
+                    ref_counts[population] += 1
+                elif allele == '1':
+                    alt_counts[population] += 1
+        variants = ''.join('\t'.join(str(count) for count in counts) + '\t\n' for
+                           counts in (ref_counts, alt_counts))
+        writer.add_snp('{0}_{1}'.format(line[0], line[1]), variants)
+    in_handle.close()
+    writer.close()
+    if multiallelic_sites:
+        print 'Skipped {0} multiallelic sites.'.format(multiallelic_sites)
+    print 'Done. Created {0} output SNPFILEs!'.format(writer.snps_written)
+
+    print '\nProgram run successful!'
+
+
+def read_population_map(population_map_path):
+    """Returns the populations in the order of their first appearance and a
+    dict with the population of each sample"""
+    print '\nReading population map...'
+    populations = []
+    sample_populations = {}
+    in_handle = open(population_map_path)
+    i = 0
+    for line in in_handle:
+        i += 1
+        line = line.strip()
+        if not line: continue
+        if line.startswith('#'): continue
+        line = line.split()
+        if len(line) != 2:
+            print 'ERROR! Two columns (sample and population) expected on ' \
+                  'line {0} of the population map, {1} found!'.format(i, len(line))
+            sys.exit(0)
+        sample_populations[line[0]] = line[1]
+        if line[1] not in populations:
+            populations.append(line[1])
+    in_handle.close()
+    print 'Read {0} samples in {1} populations.'.format(len(sample_populations),
+                                                       len(populations))
+    return populations, sample_populations
+
+
+def read_vcf_site_names(vcf_file_path):
+    """Yields the CHROM_POS names of the vcf file sites"""
+    in_handle = open(vcf_file_path)
+    i = 0
+    for line in in_handle:
+        i += 1
+        line = line.strip()
+        if not line: continue
+        if line.startswith('#'): continue
+        line = line.split('\t')
+        if len(line) < 9:
+            print 'ERROR! Vcf file format should contain at least 9 columns!'
+            print 'Line {0} had {1} columns!'.format(i, len(line))
+            sys.exit(0)
+        yield '{0}_{1}'.format(line[0], line[1])
+    in_handle.close()
+
+
+def read_snpsfile(in_file_path):
+    """Yields the two lines of each SNP in a SNPSFILE as a single string"""
+    in_handle = open(in_file_path)
     variants = []
     for line in in_handle:
         if not line.strip(): continue
-        i += 1
         variants.append(line)
-        if i%2 == 0:
-            if vcf_file_path is not None:
-                current_out_dir_path = os.path.join(out_dir_path, 'bayenv2_input_{0}.SNPFILEDIR'.format(vcf_positions[(i/2)-1]))
-                try:
-                    os.mkdir(current_out_dir_path)
-                except OSError: # Directory exists already
-                    pass
-                output_path = os.path.join(current_out_dir_path, 'bayenv2_input_{0}.SNPFILE'.format(vcf_positions[(i/2)-1]))
-                try:
-                    out_handle = open(output_path, 'w')
-                except IndexError:
-                    print 'ERROR! The vcf file has fewer variants ({0}) than the input SNPFILE ({1})!'.format(len(vcf_positions), i/2)
-                    sys.exit(0)
-            else:
-                current_out_dir_path = os.path.join(out_dir_path, 'bayenv2_input_{0}.SNPFILEDIR'.format(vcf_positions[(i / 2) - 1]))
-                try:
-                    os.mkdir(current_out_dir_path)
-                except OSError: # Directory exists already
-                    pass
-                output_path = os.path.join(current_out_dir_path, 'bayenv2_input_{0}.SNPSFILE'.format(str([i/2]).rjust(10, '0')))
-                out_handle = open(output_path)
-            out_handle.write(''.join(variants))
-            out_handle.close()
-            shutil.copy(bayenv2_executable, current_out_dir_path)
-            shutil.copy(environfile, os.path.join(current_out_dir_path, 'ENVIRONFILE.txt'))
-            shutil.copy(matrixfile, os.path.join(current_out_dir_path, 'MATRIXFILE.txt'))
+        if len(variants) == 2:
+            yield ''.join(variants)
             variants = []
+    in_handle.close()
 
-    if vcf_file_path is not None:
-        if i/2 > len(vcf_positions):
-            print 'ERROR! The vcf file has more variants ({0}) than the input SNPSFILE ({1})!'.format(len(vcf_positions), i/2)
-            print 'The names of output files are wrong!'
-            sys.exit(0)
-    print 'Done. Created {0} output SNPFILEs!'.format(i/2)
 
-    print '\nProgram run successful!'
+class snp_writer:
+    """Writes SNPs into a directory per SNP (snps_per_dir is None) or into
+    shards of snps_per_dir SNPs"""
+    def __init__(self, out_dir_path, snps_per_dir, bayenv2_executable,
+                 environfile, matrixfile):
+        self.out_dir_path = out_dir_path
+        self.snps_per_dir = snps_per_dir
+        self.snps_written = 0
+        self.shard_handle = None
+        self.shard_number = 0
+        self.shard_snps = 0
+        # (source path, file name in SNP directory) pairs
+        self.shared_files = [(bayenv2_executable,
+                              os.path.basename(bayenv2_executable)),
+                             (environfile, 'ENVIRONFILE.txt'),
+                             (matrixfile, 'MATRIXFILE.txt')]
+        if snps_per_dir is not None:
+            shared_dir_path = os.path.join(out_dir_path, 'shared_files')
+            make_dir(shared_dir_path)
+            for i, (file_path, file_name) in enumerate(self.shared_files):
+                shared_path = os.path.join(shared_dir_path, file_name)
+                shutil.copy(file_path, shared_path)
+                self.shared_files[i] = (shared_path, file_name)
+            self.manifest_handle = open(os.path.join(out_dir_path,
+                                                     'manifest.txt'), 'w')
+            self.manifest_handle.write('shard\tline\tsnp\n')
+
+    def add_snp(self, snp_name, variants):
+        if self.snps_per_dir is None:
+            current_out_dir_path = os.path.join(self.out_dir_path, 'bayenv2_input_{0}.SNPFILEDIR'.format(snp_name))
+            make_dir(current_out_dir_path)
+            output_path = os.path.join(current_out_dir_path, 'bayenv2_input_{0}.SNPFILE'.format(snp_name))
+            out_handle = open(output_path, 'w')
+            out_handle.write(variants)
+            out_handle.close()
+            for file_path, file_name in self.shared_files:
+                shutil.copy(file_path, os.path.join(current_out_dir_path,
+                                                    file_name))
+        else:
+            if self.shard_handle is None:
+                self.open_shard()
+            self.shard_handle.write(variants)
+            self.shard_snps += 1
+            self.manifest_handle.write('{0}\t{1}\t{2}\n'.format(self.shard_name,
+                                                              self.shard_snps,
+                                                              snp_name))
+            if self.shard_snps == self.snps_per_dir:
+                self.shard_handle.close()
+                self.shard_handle = None
+        self.snps_written += 1
+
+    def open_shard(self):
+        self.shard_number += 1
+        self.shard_snps = 0
+        self.shard_name = 'bayenv2_shard_{0}'.format(str(self.shard_number).rjust(6, '0'))
+        shard_dir_path = os.path.join(self.out_dir_path,
+                                      self.shard_name + '.SNPFILEDIR')
+        make_dir(shard_dir_path)
+        self.shard_handle = open(os.path.join(shard_dir_path,
+                                              self.shard_name + '.SNPSFILE'), 'w')
+        for file_path, file_name in self.shared_files:
+            link_file(file_path, os.path.join(shard_dir_path, file_name))
+
+    def close(self):
+        if self.shard_handle is not None:
+            self.shard_handle.close()
+            self.shard_handle = None
+        if self.snps_per_dir is not None:
+            self.manifest_handle.close()
+
+
+def make_dir(dir_path):
+    try:
+        os.mkdir(dir_path)
+    except OSError: # Directory exists already
+        pass
+
+
+def link_file(file_path, link_path):
+    """Hardlinks file_path to link_path, or symlinks if hardlinking fails"""
+    if os.path.lexists(link_path):
+        os.remove(link_path)
+    try:
+        os.link(file_path, link_path)
+    except OSError:
+        os.symlink(os.path.relpath(file_path, os.path.dirname(link_path)),
+                   link_path)
+
 
-bayenv2_SNPSFILE_breaker(args.input_file, args.output_dir, args.vcf_file,
-                         args.bayenv2_executable, args.environfile, args.matrixfile)
+if args.run is None or args.run.lower() in ('f', 'false'):
+    bayenv2_SNPSFILE_breaker(args.input_file, args.output_dir, args.vcf_file,
+                             args.bayenv2_executable, args.environfile,
+                             args.matrixfile, args.snps_per_dir,
+                             args.population_map)
+elif args.run.lower() in ('t', 'true'):
+    run_bayenv2(args.output_dir, args.bayenv2_executable, args.processes,
+                args.bayenv2_arguments)
+else:
+    print 'ERROR! Odd value for -r parameter. Allowed values are "true" and "false"!'
+    sys.exit(0)
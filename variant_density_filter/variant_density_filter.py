@@ -1,9 +1,13 @@
+from bisect import bisect_right
+from collections import deque
+import gzip
 import optparse
 import sys
 
+import numpy as np
 
 from VcfWalker import VCFTable
-VERSION = '15.08.21'
+VERSION = '26.10.18'
 NAME = 'variant_density_filter'
 descr = """This tool removes areas containing "too much" variation.
 
@@ -14,10 +18,32 @@ Filtering of the vcf file should therefore be performed before using this tool!
 
 The --remove_range argument can be used to make sure that paralogous area is
 completely removed by removing adjacent areas of a paralogous area.
+
+A window starts at each variant and covers the following -s bases. Windows
+are counted in a single pass over each sequence and removed areas are stored
+as merged (start, end) intervals, so memory use depends on the number of
+removed areas rather than their size. The vcf file must be sorted by position
+within each sequence.
+
+By default the vcf file is read twice: first to find the removed areas and
+then to copy the remaining variants to the output file. With -p true the file
+is read only once. The fate of a variant depends only on the variants within
+-s + -r bases of it, so only these variants are kept in memory until they can
+be written or dropped. In this mode the input can also be read from stdin
+(-i -). Input files ending with .gz are read as gzip compressed files in both
+modes.
+
+To help choosing the -s and -m values, -d writes the variant density as a
+bedGraph track instead of filtering the vcf file. The value at each variant
+position is the number of variants in the window starting at it. A histogram
+of these window counts is written to [-d].hist, where the last column tells
+how many windows a given -m value would remove. Only -s is needed in this
+mode and the input can be read from stdin.
 """
 
 parser = optparse.OptionParser(description=descr)
-parser.add_option('-i', '--input', help='path to a .vcf file')
+parser.add_option('-i', '--input', help='path to a .vcf file, - for stdin '
+                                        '(requires -p true)')
 parser.add_option('-o', '--output', help='output file path')
 parser.add_option('-s', '--sliding_window_size', help='sliding window size',
                   type=int)
@@ -25,12 +51,17 @@ parser.add_option('-m', '--max_variants', help='maximum number of variants in wi
                   type = int)
 parser.add_option('-r', '--remove_range', help='size of adjacent area which '
                                                'will be removed', type=int)
+parser.add_option('-p', '--single_pass', help='read the vcf file only once '
+                                              '(true/false, def false)')
+parser.add_option('-d', '--density_track', help='write variant densities to '
+                                                'this bedGraph file instead of '
+                                                'filtering')
 
 args = parser.parse_args()[0]
 
 
 def variant_density_filter(in_path, out_path, sliding_window_size, max_variants,
-                  remove_range):
+                  remove_range, single_pass, density_track_path):
     if remove_range is None:
         remove_range = 0
     else:
@@ -39,59 +70,97 @@ def variant_density_filter(in_path, out_path, sliding_window_size, max_variants,
         except ValueError:
             print 'The --remove_range option required an integer as a value!'
             sys.exit(1)
+    if single_pass is None or single_pass.lower() in ('f', 'false'):
+        single_pass = False
+    elif single_pass.lower() in ('t', 'true'):
+        single_pass = True
+    else:
+        print 'Error! Odd value for -p parameter. Allowed values are "true" and "false"!'
+        sys.exit(1)
+    if density_track_path is not None:
+        if sliding_window_size is None:
+            print 'Error! Window size (-s) is required for the density track!'
+            sys.exit(1)
+        density_track(in_path, density_track_path, sliding_window_size)
+        return
+    if in_path == '-' and not single_pass:
+        print 'Error! Reading the vcf file from stdin requires -p true!'
+        sys.exit(1)
+
+    if single_pass:
+        vcf_handle = open_vcf(in_path)
+        try:
+            output_handle = open(out_path, 'w')
+        except IOError as ex:
+            print 'Error! Unable to create output file, reason: {0}'.format(str(ex))
+            sys.exit(1)
+        print '\nFiltering the vcf file...'
+        total_sites, sites_filtered, size_of_removed_area = \
+            filter_single_pass(vcf_handle, output_handle, sliding_window_size,
+                               max_variants, remove_range)
+        vcf_handle.close()
+        output_handle.close()
+    else:
+        total_sites, sites_filtered, size_of_removed_area = \
+            filter_two_pass(in_path, out_path, sliding_window_size,
+                            max_variants, remove_range)
+
+    log_handle = open(out_path+'.log', 'w')
+    log_handle.write('{0} {1}\n\n'.format(NAME, VERSION))
+    log_handle.write('Size of the removed area: {0}\n'.format(size_of_removed_area))
+    log_handle.write('\nOriginal number of variants\tVariants removed\n')
+    log_handle.write('{0}\t{1}'.format(str(total_sites), str(sites_filtered)))
+    log_handle.close()
+
+    print 'Done.'
+    print 'Size of the removed area: {0}'.format(size_of_removed_area)
+    print '\nOriginal number of variants\tVariants removed'
+    print '{0}\t{1}'.format(str(total_sites), str(sites_filtered))
 
-    vcf_handle = open(in_path)
+
+def open_vcf(in_path):
+    """Opens a plain or gzip compressed vcf file, - for stdin"""
+    if in_path == '-':
+        return sys.stdin
+    if in_path.endswith('.gz'):
+        return gzip.open(in_path)
+    return open(in_path)
+
+
+def filter_two_pass(in_path, out_path, sliding_window_size, max_variants,
+                    remove_range):
+    """Finds the removed areas and then copies the remaining variants to the
+    output file. Returns the number of variants, the number of removed variants
+    and the size of the removed area."""
+    vcf_handle = open_vcf(in_path)
     vcf_file = VCFTable(vcf_handle)
     #remove_areas has sequence ID (scaffold/contig) as a key. Areas to remove
-    #  in this ID is a set of positions (int).
+    #  in this ID are stored in a remove_area object.
     remove_areas = {}
 
     #First iteration of file - detect paralogous areas
     print '\nSliding the window...'
-    sliding_windows = []
-    size_of_removed_area = 0
-    current_chr = ''
+    window = None
+    current_chr = None
     for line in vcf_handle:
         if vcf_file.isHeader(line):
             continue
 
         line = line.strip()
         line = line.split('\t')
-        print 'CURRENT LINE', vcf_file.seq(line), vcf_file.pos(line)
-        if vcf_file.seq(line) == current_chr:
-            print 'current chromosome'
-            for window in sliding_windows:
-                window.add_variant(vcf_file.pos(line))
-            sliding_windows.append(sliding_window(max_variants,
-                                                  sliding_window_size,
-                                                  current_chr,
-                                                  vcf_file.pos(line),
-                                                  remove_range))
-        else:
-            print 'Initializing new chromosome'
-            remove_areas[current_chr] = set()
-            for window in sliding_windows:
-                remove_areas[current_chr] = remove_areas[current_chr].union(window.remove_area)
-            try:
-                size_of_removed_area += len(remove_areas[current_chr])
-            except KeyError:
-                pass
-            sliding_windows = [sliding_window(max_variants,
-                                              sliding_window_size,
-                                              current_chr,
-                                              vcf_file.pos(line),
-                                              remove_range)]
+        if vcf_file.seq(line) != current_chr:
+            if window is not None:
+                window.finish()
             current_chr = vcf_file.seq(line)
-
-        #raw_input('enter')
+            if current_chr not in remove_areas:
+                remove_areas[current_chr] = remove_area()
+            window = sliding_window(max_variants, sliding_window_size,
+                                    remove_range, remove_areas[current_chr])
+        window.add_variant(vcf_file.pos(line))
     #Handle the last chromosome
-    remove_areas[current_chr] = set()
-    for window in sliding_windows:
-        remove_areas[current_chr].union(window.remove_area)
-        try:
-            size_of_removed_area += len(remove_areas[current_chr])
-        except KeyError:
-            pass
+    if window is not None:
+        window.finish()
+    size_of_removed_area = sum(area.size() for area in remove_areas.values())
 
     vcf_handle.close()
 
@@ -105,7 +174,7 @@ def variant_density_filter(in_path, out_path, sliding_window_size, max_variants,
     except IOError as ex:
         print 'Error! Unable to create output file, reason: {0}'.format(str(ex))
         sys.exit(1)
-    vcf_handle = open(in_path)
+    vcf_handle = open_vcf(in_path)
     for line in vcf_handle:
         if vcf_file.isHeader(line):
             output_handle.write(line)
@@ -121,64 +190,215 @@ def variant_density_filter(in_path, out_path, sliding_window_size, max_variants,
                 sites_filtered += 1
                 continue
         output_handle.write(line)
+    vcf_handle.close()
     output_handle.close()
+    return total_sites, sites_filtered, size_of_removed_area
+
+
+def filter_single_pass(vcf_handle, output_handle, sliding_window_size,
+                       max_variants, remove_range):
+    """Filters the vcf file in a single pass. Returns the number of variants,
+    the number of removed variants and the size of the removed area.
+
+    A variant at position q is removed by the windows starting between
+    q - window size - remove range and q + remove range. Variants are buffered
+    until the first unfinished window starts after q + remove range, so the
+    buffer spans at most window size + remove range bases.
+    """
+    vcf_file = VCFTable(vcf_handle)
+    total_sites = 0
+    sites_filtered = 0
+    size_of_removed_area = 0
+    #Buffered (position, line) pairs of the current chromosome
+    buffered_lines = deque()
+    window = None
+    area = None
+    current_chr = None
+    for line in vcf_handle:
+        if vcf_file.isHeader(line):
+            output_handle.write(line)
+            continue
+
+        total_sites += 1
+        split_line = line.strip()
+        split_line = split_line.split('\t')
+        if vcf_file.seq(split_line) != current_chr:
+            if window is not None:
+                window.finish()
+                sites_filtered += write_buffered_lines(buffered_lines, area,
+                                                       output_handle)
+                size_of_removed_area += area.size()
+            current_chr = vcf_file.seq(split_line)
+            area = remove_area()
+            window = sliding_window(max_variants, sliding_window_size,
+                                    remove_range, area)
+        pos = vcf_file.pos(split_line)
+        window.add_variant(pos)
+        buffered_lines.append((pos, line))
+        sites_filtered += write_buffered_lines(buffered_lines, area,
+                                               output_handle,
+                                               window.positions[0] - remove_range)
+    #Handle the last chromosome
+    if window is not None:
+        window.finish()
+        sites_filtered += write_buffered_lines(buffered_lines, area,
+                                               output_handle)
+        size_of_removed_area += area.size()
+    return total_sites, sites_filtered, size_of_removed_area
+
+
+def write_buffered_lines(buffered_lines, area, output_handle, before_pos=None):
+    """Writes or drops the buffered lines with position below before_pos (all
+    lines if before_pos is None). Returns the number of dropped lines."""
+    sites_filtered = 0
+    while buffered_lines and (before_pos is None or
+                              buffered_lines[0][0] < before_pos):
+        pos, line = buffered_lines.popleft()
+        if pos in area:
+            sites_filtered += 1
+        else:
+            output_handle.write(line)
+    return sites_filtered
 
-    log_handle = open(out_path+'.log', 'w')
-    log_handle.write('{0} {1}\n\n'.format(NAME, VERSION))
-    log_handle.write('Size of the removed area: {0}\n'.format('size_of_removed_area'))
-    log_handle.write('\nOriginal number of variants\tVariants removed\n')
-    log_handle.write('{0}\t{1}'.format(str(total_sites), str(sites_filtered)))
-    log_handle.close()
+
+def density_track(in_path, track_path, sliding_window_size):
+    """Writes the number of variants in the window starting at each variant as
+    a bedGraph track and a histogram of the window counts"""
+    vcf_handle = open_vcf(in_path)
+    vcf_file = VCFTable(vcf_handle)
+    try:
+        track_handle = open(track_path, 'w')
+    except IOError as ex:
+        print 'Error! Unable to create output file, reason: {0}'.format(str(ex))
+        sys.exit(1)
+
+    print '\nCalculating variant densities...'
+    #histogram[i] is the number of windows containing i variants
+    histogram = np.zeros(0, dtype=np.int64)
+    positions = []
+    current_chr = None
+    for line in vcf_handle:
+        if vcf_file.isHeader(line):
+            continue
+
+        line = line.strip()
+        line = line.split('\t')
+        if vcf_file.seq(line) != current_chr:
+            histogram = write_density_track(track_handle, current_chr,
+                                            positions, sliding_window_size,
+                                            histogram)
+            current_chr = vcf_file.seq(line)
+            positions = []
+        positions.append(vcf_file.pos(line))
+    histogram = write_density_track(track_handle, current_chr, positions,
+                                    sliding_window_size, histogram)
+    vcf_handle.close()
+    track_handle.close()
+
+    hist_handle = open(track_path+'.hist', 'w')
+    hist_handle.write('{0} {1}\n\n'.format(NAME, VERSION))
+    hist_handle.write('Window size: {0}\n'.format(sliding_window_size))
+    hist_handle.write('\nVariants in window\tWindows\tWindows with more variants\n')
+    windows_over = histogram[::-1].cumsum()[::-1] - histogram
+    for variants, windows, over in zip(range(len(histogram)),
+                                       histogram.tolist(),
+                                       windows_over.tolist()):
+        if windows:
+            hist_handle.write('{0}\t{1}\t{2}\n'.format(variants, windows, over))
+    hist_handle.close()
 
     print 'Done.'
-    print 'Size of the removed area: {0}'.format(size_of_removed_area)
-    print '\nOriginal number of variants\tVariants removed'
-    print '{0}\t{1}'.format(str(total_sites), str(sites_filtered))
+    print 'Number of windows: {0}'.format(histogram.sum())
+    if histogram.sum():
+        print 'Median number of variants in window: {0}'.format(
+            np.searchsorted(histogram.cumsum(), (histogram.sum()+1)/2))
+        print 'Maximum number of variants in window: {0}'.format(len(histogram)-1)
+
+
+def write_density_track(track_handle, chrom, positions, sliding_window_size,
+                        histogram):
+    """Writes the bedGraph lines of one sequence and returns the histogram
+    updated with its window counts"""
+    if not positions:
+        return histogram
+    positions = np.array(positions, dtype=np.int64)
+    #The window starting at variant i ends before the first variant beyond
+    #  positions[i] + sliding_window_size
+    counts = np.searchsorted(positions, positions + sliding_window_size,
+                             side='right') - np.arange(len(positions))
+    #Windows of variants sharing a position are reported once, using the
+    #  first (largest) one
+    unique_positions, first_index = np.unique(positions, return_index=True)
+    for pos, count in zip(unique_positions.tolist(),
+                          counts[first_index].tolist()):
+        track_handle.write('{0}\t{1}\t{2}\t{3}\n'.format(chrom, pos-1, pos,
+                                                          count))
+    chrom_histogram = np.bincount(counts)
+    if len(chrom_histogram) > len(histogram):
+        chrom_histogram[:len(histogram)] += histogram
+        return chrom_histogram
+    histogram[:len(chrom_histogram)] += chrom_histogram
+    return histogram
 
 
 class sliding_window:
-    def __init__(self, max_variants, window_size, chrom, start_pos,
-                 remove_range):
+    """Counts the variants of the windows starting at each variant of one
+    sequence. Positions must be added in sorted order. Windows containing more
+    than max_variants variants are added to the remove_area object.
+
+    The positions of the unfinished windows are kept in a deque: a window is
+    finished when a variant beyond its end is added, and at that point the
+    deque holds exactly the variants of the window.
+    """
+    def __init__(self, max_variants, window_size, remove_range, area):
         self.max_variants = max_variants
         self.window_size = window_size
-        self.chrom = chrom
-        self.start_pos = start_pos
-        self.end_position = start_pos + window_size
         self.remove_range = remove_range
-
-        self.positions = [start_pos]
-        self.remove_area = set()
-        print 'Created window:'
-        print 'max_variants', max_variants
-        print 'window_size', window_size
-        print 'chrom', chrom
-        print 'start_pos', start_pos
-        print 'end_pos', self.end_position
-        print 'remove_range', remove_range
+        self.area = area
+        self.positions = deque()
 
     def add_variant(self, pos):
-        print '\nadding pos {0} to window {1}, {2}'.format(pos,
-                                                         self.chrom,
-                                                         self.start_pos)
-        if self.end_position < pos:
-            print 'Not added, position over end point'
-            return
-        if self.remove_area:
-            print 'not added, this area has already been removed'
-            return
-
+        while self.positions and self.positions[0] + self.window_size < pos:
+            self.finish_window()
         self.positions.append(pos)
-        print len(self.positions), self.max_variants
-        print len(self.positions) > self.max_variants
+
+    def finish_window(self):
+        start_pos = self.positions[0]
         if len(self.positions) > self.max_variants:
-            self.remove_area = range(self.start_pos-self.remove_range,
-                                     self.end_position+self.remove_range+1)
-            self.remove_area = set(self.remove_area)
-            print '-----!!!!!Marking this window to be removed!!!!!-----'
-            print self.remove_area
-        print '\n\n'
-        return
+            self.area.add(start_pos - self.remove_range,
+                          start_pos + self.window_size + self.remove_range)
+        self.positions.popleft()
+
+    def finish(self):
+        """Finishes the remaining windows at the end of the sequence"""
+        while self.positions:
+            self.finish_window()
+
+
+class remove_area:
+    """Removed positions of one sequence as merged (start, end) intervals
+    (both inclusive). Intervals must be added in the order of their start
+    positions."""
+    def __init__(self):
+        self.starts = []
+        self.ends = []
+
+    def add(self, start, end):
+        start = max(start, 1)
+        if self.ends and start <= self.ends[-1] + 1:
+            self.ends[-1] = max(self.ends[-1], end)
+        else:
+            self.starts.append(start)
+            self.ends.append(end)
+
+    def __contains__(self, pos):
+        i = bisect_right(self.starts, pos) - 1
+        return i >= 0 and pos <= self.ends[i]
+
+    def size(self):
+        return sum(end - start + 1 for start, end in zip(self.starts, self.ends))
 
 
 variant_density_filter(args.input, args.output, args.sliding_window_size,
-                       args.max_variants, args.remove_range)
+                       args.max_variants, args.remove_range, args.single_pass,
+                       args.density_track)
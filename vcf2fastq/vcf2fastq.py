@@ -1,5 +1,10 @@
+from collections import deque
+import multiprocessing
 import optparse
+import os
+import shutil
 import sys
+import tempfile
 
 IUPAC_bases2dna = dict({"AA":"A","CC":"C","GG":"G","TT":"T",
                "AG":"R","CT":"Y","AC":"M","GT":"K",
@@ -7,13 +12,41 @@ IUPAC_bases2dna = dict({"AA":"A","CC":"C","GG":"G","TT":"T",
                "ACT":"H","ACG":"V","ACGT":"N"})
 FASTQ_quality_string = '''!"#$%&'()*+,-./0123456789:;<=>?@ABCDEFGHIJKLMNOPQRSTUVWXYZ[\]^_`abcdefghijklmnopqrstuvwxyz{|}~'''
 
-VERSION = '17.04.24'
+# Maximum number of bases kept in memory before writing them to disk
+BUFFER_SIZE = 1000000
+
+VERSION = '26.10.18'
 NAME = 'vcf2fastq'
 descr = """
 This program converts single sample vcf-files into fastq files. Fastq quality
 values are taken from the sample field's genotype quality. Input vcf files
 should be sorted by position.
 
+Sequences are written to the output file while the vcf file is read, so memory
+usage does not depend on the length of the scaffolds. Quality values of the
+current scaffold are kept in a temporary file until the scaffold has been
+read.
+
+Multi-sample vcf files can be converted with the -s parameter, which takes a
+comma delimited list of sample names, a path to a file containing a sample
+name on each row or "all". The vcf file is then read only once and a fastq
+file named [sample name].fq is written for each sample into the output
+directory (-o). The BUFFER_SIZE bases kept in memory are shared between the
+samples.
+
+PSMC input can also be written directly (-f psmcfa), which gives the same
+result as running fq2psmcfa on the fastq output. The sequence is divided into
+bins of -b bases. Bases with quality below -q or missing genotypes are
+ignored. A bin is missing (N) if less than half of its bases remain,
+heterozygous (K) if it contains a heterozygous genotype and homozygous (T)
+otherwise. With -s the output files are named [sample name].psmcfa.
+
+Scaffolds can be converted in parallel (-w parameter). Scaffold boundaries
+are located by binary search over the byte offsets of the sorted vcf file, so
+each scaffold must appear in one contiguous block. Scaffolds are converted
+into temporary files, which are concatenated in input order. The output is
+identical to a run with a single worker.
+
 This program was created to produce suitable input files for psmc fq2psmcfa
 script (Li & Durbin 2011 Inference of Human Population History From Whole
 Genome Sequence of A Single Individual. Nature 475(7357):493-496)
@@ -24,66 +57,450 @@ print '\nRunning {0} v.{1}'.format(NAME, VERSION)
 parser = optparse.OptionParser(description=descr)
 parser.add_option('-i', '--input', help='path to an input file (vcf)',
                   type='string')
-parser.add_option('-o', '--output_file', help='output file path',
+parser.add_option('-o', '--output_file', help='output file path (output '
+                                              'directory if -s is used)',
                   type='string')
+parser.add_option('-s', '--samples', help='convert these samples of a '
+                                          'multi-sample vcf file: "all", a '
+                                          'comma delimited list or a path to '
+                                          'a file listing sample names '
+                                          '(optional)',
+                  type='string')
+parser.add_option('-f', '--output_format', help='output format: fastq or '
+                                                'psmcfa (def fastq)',
+                  type='string')
+parser.add_option('-q', '--psmc_min_quality', help='minimum base quality in '
+                                                   'psmcfa output (def 10)',
+                  type='int')
+parser.add_option('-b', '--psmc_bin_size', help='number of bases in each '
+                                                'psmcfa bin (def 100)',
+                  type='int')
+parser.add_option('-w', '--workers', help='number of scaffolds converted in '
+                                          'parallel (def 1)',
+                  type='int')
 args = parser.parse_args()[0]
 
-def vcf2fastq(in_path, out_path):
+def vcf2fastq(in_path, out_path, samples, output_format, psmc_min_quality,
+              psmc_bin_size, workers):
+    if output_format is None:
+        output_format = 'fastq'
+    output_format = output_format.lower()
+    if output_format not in ('fastq', 'psmcfa'):
+        print 'Error! Odd value for -f parameter. Allowed values are "fastq" ' \
+              'and "psmcfa"!'
+        sys.exit(0)
+    if psmc_min_quality is None:
+        psmc_min_quality = 10
+    if psmc_bin_size is None:
+        psmc_bin_size = 100
+    elif psmc_bin_size < 1:
+        print 'Error! Bin size (-b) must be at least 1!'
+        sys.exit(0)
+    if workers is None:
+        workers = 1
+    elif workers < 1:
+        print 'Error! Number of workers (-w) must be at least 1!'
+        sys.exit(0)
+    writer_settings = (output_format, psmc_min_quality, psmc_bin_size)
+
+    sample_columns, variants_offset = read_vcf_header(in_path, samples)
+    if samples is None:
+        out_paths = [out_path]
+    else:
+        if not os.path.isdir(out_path):
+            os.mkdir(out_path)
+        if output_format == 'psmcfa':
+            file_name = '{0}.psmcfa'
+        else:
+            file_name = '{0}.fq'
+        out_paths = [os.path.join(out_path, file_name.format(sample_name)) for
+                     sample_name, column in sample_columns]
+        print 'Converting {0} samples.'.format(len(sample_columns))
+    columns = [column for sample_name, column in sample_columns]
+    # The bases kept in memory are shared by all samples
+    buffer_size = max(1, BUFFER_SIZE/len(columns))
+    out_handles = [open(path, 'w') for path in out_paths]
+
+    if workers == 1:
+        in_handle = open(in_path)
+        in_handle.seek(variants_offset)
+        sample_writers = [(column, open_writer(out_handle, buffer_size,
+                                               writer_settings)) for
+                          column, out_handle in zip(columns, out_handles)]
+        variants_found = convert_vcf_lines(in_handle, sample_writers, True)
+        in_handle.close()
+        if not variants_found:
+            print 'Error! No variants found in the vcf file!'
+            sys.exit(0)
+    else:
+        scaffold_ranges = find_scaffold_ranges(in_path, variants_offset)
+        if not scaffold_ranges:
+            print 'Error! No variants found in the vcf file!'
+            sys.exit(0)
+        print 'Converting {0} scaffolds using {1} workers...'.format(len(scaffold_ranges),
+                                                                   workers)
+        # Temporary files are written next to the output
+        if samples is None:
+            temp_parent_dir = os.path.dirname(os.path.abspath(out_path))
+        else:
+            temp_parent_dir = out_path
+        temp_dir = tempfile.mkdtemp(prefix='vcf2fastq_', dir=temp_parent_dir)
+        pool = multiprocessing.Pool(workers)
+        try:
+            # Only a limited number of scaffolds are submitted to the pool at
+            # a time, so that the files of converted scaffolds do not pile up
+            # while earlier scaffolds are being copied
+            def converted_scaffolds():
+                pending_results = deque()
+                for start, end in scaffold_ranges:
+                    pending_results.append(pool.apply_async(convert_scaffold,
+                                                            ((in_path, start, end,
+                                                              columns, buffer_size,
+                                                              writer_settings,
+                                                              temp_dir),)))
+                    if len(pending_results) >= workers * 2:
+                        yield pending_results.popleft().get()
+                while pending_results:
+                    yield pending_results.popleft().get()
+            # Scaffolds are returned in input order
+            for scaffolds_done, temp_paths in enumerate(converted_scaffolds(), 1):
+                for temp_path, out_handle in zip(temp_paths, out_handles):
+                    temp_handle = open(temp_path)
+                    shutil.copyfileobj(temp_handle, out_handle)
+                    temp_handle.close()
+                    os.remove(temp_path)
+                if scaffolds_done % 1000 == 0:
+                    print '{0}/{1} scaffolds converted...'.format(scaffolds_done,
+                                                                  len(scaffold_ranges))
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+            shutil.rmtree(temp_dir, ignore_errors=True)
+    for out_handle in out_handles:
+        out_handle.close()
+    print 'File conversion successfull!'
+
+
+def open_writer(out_handle, buffer_size, writer_settings):
+    """Returns a fastq_writer or a psmcfa_writer according to writer_settings
+    (output format, psmc minimum quality, psmc bin size)"""
+    output_format, psmc_min_quality, psmc_bin_size = writer_settings
+    if output_format == 'psmcfa':
+        return psmcfa_writer(out_handle, psmc_min_quality, psmc_bin_size)
+    return fastq_writer(out_handle, buffer_size)
+
+
+def read_vcf_header(in_path, samples):
+    """Returns the (sample name, column index) pairs to convert and the byte
+    offset of the first variant line"""
     in_handle = open(in_path)
-    out_handle = open(out_path, 'w')
+    sample_columns = None
+    offset = 0
+    while True:
+        line = in_handle.readline()
+        if not line.startswith('#'):
+            break
+        offset += len(line)
+        if line.startswith('##'): continue
+        line = line.split('\t')
+        if samples is not None:
+            sample_columns = select_sample_columns(line, samples)
+        elif len(line) != 10:
+            print 'Error! A single sample vcf file is expected as input ' \
+                  'containing 10 columns, {0} columns found!'.format(len(line))
+    in_handle.close()
+    if samples is None:
+        # Single sample vcf file, sample is on column 10
+        sample_columns = [(None, 9)]
+    elif sample_columns is None:
+        print 'Error! Header line containing sample names was not found ' \
+              'before the first variant!'
+        sys.exit(0)
+    return sample_columns, offset
+
 
+def convert_vcf_lines(lines, sample_writers, report_progress):
+    """Converts vcf variant lines using the (column, writer) pairs of
+    sample_writers. Returns False if there were no variants."""
     prev_scaffold = None
     lines_processed = 0
-    for line in in_handle:
+    for line in lines:
         lines_processed += 1
-        if lines_processed % 1000000 == 0:
+        if report_progress and lines_processed % 1000000 == 0:
             print '{0} million vcf-file lines processed...'.format(lines_processed/1000000)
         # Skip empty and header lines
         line.strip()
-        if line.startswith('##'): continue
+        if line.startswith('#'): continue
         if not line: continue
         line = line.split('\t')
-        if line[0].startswith('#'):
-            if len(line) != 10:
-                print 'Error! A single sample vcf file is expected as input ' \
-                      'containing 10 columns, {0} columns found!'.format(len(line))
-            continue
         #Parse and write output
         scaffold = line[0]
         position = int(line[1])
         if prev_scaffold is None: # i.e. the first row
-            sequence = []
-            sequence_quality = []
+            for column, writer in sample_writers:
+                writer.start_record(scaffold)
         elif scaffold != prev_scaffold: # Write output when scaffold changes
-            out_handle.write('@{0}\n'.format(prev_scaffold))
-            out_handle.write('{0}\n+\n'.format(''.join(sequence)))
-            out_handle.write('{0}\n'.format(''.join(sequence_quality)))
-            sequence = []
-            sequence_quality = []
+            for column, writer in sample_writers:
+                writer.finish_record()
+                writer.start_record(scaffold)
         else:
-            if position != (prev_position + 1): # Write 'n' character for gaps in sequence
-                sequence += ['n']*(position-prev_position-1)
-                sequence_quality += ['!'*(position-prev_position-1)]
-            sequence.append(parse_genotype(line))
-            # If genotype is missing, use the lowest quality GQ value
-            if sequence[-1] == 'n':
-                sequence_quality.append('!')
-            else:
-                sequence_quality.append(parse_genotype_quality(line))
+            for column, writer in sample_writers:
+                if position != (prev_position + 1): # Write 'n' character for gaps in sequence
+                    writer.add_gap(position-prev_position-1)
+                base = parse_genotype(line, column)
+                # If genotype is missing, use the lowest quality GQ value
+                if base == 'n':
+                    writer.add_base(base, '!')
+                else:
+                    writer.add_base(base, parse_genotype_quality(line, column))
         prev_scaffold = scaffold
         prev_position = position
+    if prev_scaffold is None:
+        return False
     # Write the last sequence
-    out_handle.write('@{0}\n'.format(prev_scaffold))
-    out_handle.write('{0}\n+\n'.format(''.join(sequence)))
-    out_handle.write('{0}\n'.format(''.join(sequence_quality)))
+    for column, writer in sample_writers:
+        writer.finish_record()
+        writer.close()
+    return True
+
+
+def find_scaffold_ranges(in_path, variants_offset):
+    """Returns the (start, end) byte offsets of each scaffold in a vcf file.
+
+    Since each scaffold is expected to be in one contiguous block, the end of
+    a scaffold can be found with a binary search: if the lines at two offsets
+    belong to the same scaffold, so do all lines between them.
+    """
+    in_handle = open(in_path)
+    in_handle.seek(0, os.SEEK_END)
+    file_size = in_handle.tell()
+
+    def scaffold_at(offset):
+        """Returns the start offset and scaffold of the first line starting
+        at or after offset"""
+        if offset > variants_offset:
+            in_handle.seek(offset - 1)
+            in_handle.readline()
+        else:
+            in_handle.seek(variants_offset)
+        line_offset = in_handle.tell()
+        line = in_handle.readline()
+        if not line.strip():
+            return file_size, None
+        return line_offset, line.split('\t', 1)[0]
+
+    scaffold_ranges = []
+    start, scaffold = scaffold_at(variants_offset)
+    while scaffold is not None:
+        # The line at low belongs to the scaffold, the line at high does not
+        low = start
+        high = file_size
+        while high - low > 1:
+            middle = (low + high)/2
+            if scaffold_at(middle)[1] == scaffold:
+                low = middle
+            else:
+                high = middle
+        end, next_scaffold = scaffold_at(high)
+        scaffold_ranges.append((start, end))
+        start, scaffold = end, next_scaffold
     in_handle.close()
-    out_handle.close()
-    print 'File conversion successfull!'
+    return scaffold_ranges
+
+
+def read_lines(in_handle, start, end):
+    """Yields the lines between the byte offsets start and end"""
+    in_handle.seek(start)
+    offset = start
+    while offset < end:
+        line = in_handle.readline()
+        if not line:
+            break
+        offset += len(line)
+        yield line
+
+
+def convert_scaffold(task):
+    """Converts the vcf lines of one scaffold into temporary files (one for
+    each sample column) and returns their paths"""
+    in_path, start, end, columns, buffer_size, writer_settings, temp_dir = task
+    in_handle = open(in_path)
+    temp_paths = []
+    out_handles = []
+    sample_writers = []
+    for column in columns:
+        temp_handle, temp_path = tempfile.mkstemp(dir=temp_dir)
+        temp_paths.append(temp_path)
+        out_handles.append(os.fdopen(temp_handle, 'w'))
+        sample_writers.append((column, open_writer(out_handles[-1], buffer_size,
+                                                   writer_settings)))
+    convert_vcf_lines(read_lines(in_handle, start, end), sample_writers, False)
+    in_handle.close()
+    for out_handle in out_handles:
+        out_handle.close()
+    return temp_paths
+
+
+def select_sample_columns(header_line, samples):
+    """Returns (sample name, column index) pairs of the samples to convert.
+    samples is "all", a comma delimited list or a path to a file listing
+    sample names."""
+    vcf_samples = [name.strip() for name in header_line[9:]]
+    if samples.lower() == 'all':
+        selected_samples = vcf_samples
+    elif os.path.isfile(samples):
+        selected_samples = []
+        in_handle = open(samples)
+        for line in in_handle:
+            line = line.strip()
+            if not line: continue
+            selected_samples.append(line)
+        in_handle.close()
+    else:
+        selected_samples = samples.split(',')
+    missing_samples = [name for name in selected_samples if name not in vcf_samples]
+    if missing_samples:
+        print 'Error! Samples not found in the vcf file: {0}'.format(', '.join(missing_samples))
+        sys.exit(0)
+    if not selected_samples:
+        print 'Error! No samples selected for conversion!'
+        sys.exit(0)
+    return [(name, vcf_samples.index(name) + 9) for name in selected_samples]
+
+
+class fastq_writer:
+    """Writes fastq records base by base without keeping whole sequences in
+    memory.
+
+    Sequence is written to the output file in chunks of buffer_size bases.
+    Quality values are written to a temporary spool file and appended to the
+    output file when the record is finished.
+    """
+    def __init__(self, out_handle, buffer_size):
+        self.out_handle = out_handle
+        self.buffer_size = buffer_size
+        self.quality_handle = tempfile.TemporaryFile()
+        self.sequence = []
+        self.sequence_quality = []
+
+    def start_record(self, name):
+        self.out_handle.write('@{0}\n'.format(name))
+        self.quality_handle.seek(0)
+        self.quality_handle.truncate()
+
+    def add_base(self, base, quality):
+        self.sequence.append(base)
+        self.sequence_quality.append(quality)
+        if len(self.sequence) >= self.buffer_size:
+            self.flush()
+
+    def add_gap(self, length):
+        """Writes a run of missing bases with the lowest quality"""
+        self.flush()
+        while length > 0:
+            run_length = min(length, self.buffer_size)
+            self.out_handle.write('n'*run_length)
+            self.quality_handle.write('!'*run_length)
+            length -= run_length
+
+    def flush(self):
+        self.out_handle.write(''.join(self.sequence))
+        self.quality_handle.write(''.join(self.sequence_quality))
+        self.sequence = []
+        self.sequence_quality = []
+
+    def finish_record(self):
+        self.flush()
+        self.out_handle.write('\n+\n')
+        self.quality_handle.seek(0)
+        shutil.copyfileobj(self.quality_handle, self.out_handle)
+        self.out_handle.write('\n')
+
+    def close(self):
+        self.quality_handle.close()
+
+
+class psmcfa_writer:
+    """Writes psmcfa records base by base like fq2psmcfa would write them
+    from the fastq output.
+
+    Only the counts of the current bin are kept in memory. Bins are written
+    60 per line.
+    """
+    def __init__(self, out_handle, min_quality, bin_size):
+        self.out_handle = out_handle
+        self.min_quality = min_quality
+        self.bin_size = bin_size
+
+    def start_record(self, name):
+        self.out_handle.write('>{0}'.format(name))
+        self.bins_written = 0
+        self.bin_bases = 0
+        self.good_bases = 0
+        self.heterozygous = False
+
+    def add_base(self, base, quality):
+        base = base.upper()
+        if base != 'N' and ord(quality) - 33 >= self.min_quality:
+            self.good_bases += 1
+            if base not in 'ACGT':
+                self.heterozygous = True
+        self.bin_bases += 1
+        if self.bin_bases == self.bin_size:
+            self.write_bin()
+
+    def add_gap(self, length):
+        """Adds a run of missing bases, whole bins are written in bulk"""
+        if length <= 0:
+            return
+        if self.bin_bases:
+            filled = min(length, self.bin_size - self.bin_bases)
+            self.bin_bases += filled
+            length -= filled
+            if self.bin_bases < self.bin_size:
+                return
+            self.write_bin()
+        # Bins of missing bases only
+        self.write_bins(self.bin_type(0, False), length/self.bin_size)
+        self.bin_bases = length % self.bin_size
+
+    def bin_type(self, good_bases, heterozygous):
+        if good_bases < self.bin_size/2:
+            return 'N'
+        elif heterozygous:
+            return 'K'
+        return 'T'
+
+    def write_bin(self):
+        self.write_bins(self.bin_type(self.good_bases, self.heterozygous), 1)
+        self.bin_bases = 0
+        self.good_bases = 0
+        self.heterozygous = False
+
+    def write_bins(self, bin_type, count):
+        while count > 0:
+            if self.bins_written % 60 == 0:
+                self.out_handle.write('\n')
+            line_bins = min(count, 60 - self.bins_written % 60)
+            self.out_handle.write(bin_type*line_bins)
+            self.bins_written += line_bins
+            count -= line_bins
+
+    def finish_record(self):
+        # The last bin may be shorter than bin_size
+        if self.bin_bases:
+            self.write_bin()
+        self.out_handle.write('\n')
+
+    def close(self):
+        pass
 
 
-def parse_genotype(line):
-    """Extracts the genotype from vcf file line"""
-    gt_field = line[9].split('\t')[0]
+def parse_genotype(line, column=9):
+    """Extracts the genotype of the sample on the given column from vcf file
+    line"""
+    gt_field = line[column].split('\t')[0]
     gt_field = gt_field.split(':')[0]
     if gt_field in ('.', './.', '.|.'):
         return 'n'
@@ -109,9 +526,10 @@ def parse_genotype(line):
     return IUPAC_bases2dna[''.join(sorted(genotypes))]
 
 
-def parse_genotype_quality(line):
-    """Extracts the genotype quality (GQ) from vcf file line"""
-    sample_fields = line[9].split(':')
+def parse_genotype_quality(line, column=9):
+    """Extracts the genotype quality (GQ) of the sample on the given column
+    from vcf file line"""
+    sample_fields = line[column].split(':')
     try:
         GQ_index = line[8].split(':').index('GQ')
     except ValueError:
@@ -129,4 +547,5 @@ def parse_genotype_quality(line):
         sys.exit(0)
 
 
-vcf2fastq(args.input, args.output_file)
+vcf2fastq(args.input, args.output_file, args.samples, args.output_format,
+          args.psmc_min_quality, args.psmc_bin_size, args.workers)
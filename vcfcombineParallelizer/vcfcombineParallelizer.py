@@ -1,15 +1,47 @@
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+import gzip
+import heapq
+import multiprocessing
 import operator
 import optparse
 import os
+import Queue
+import re
+import shutil
+import struct
+import subprocess
 import sys
+import time
+import traceback
+import zlib
 
 NAME = 'vcfcombineParallelizer'
-VERSION = '17.04.11'
+VERSION = '26.10.18'
 AUTHOR = 'Jaakko Tyrmi'
+# Uncompressed size of a bgzip block
+BGZF_BLOCK_SIZE = 65280
+BGZF_EOF = '\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00BC\x02\x00' \
+           '\x1b\x00\x03\x00\x00\x00\x00\x00\x00\x00\x00\x00'
+# Maximum number of part files kept open when splitting a vcf file
+MAX_OPEN_FILES = 500
+# Bytes of records copied from each vcf file for benchmarking
+BENCHMARK_SLICE_SIZE = 10000000
+# Estimated run times and memory usage are multiplied by this
+ESTIMATE_MARGIN = 2.0
+MIN_JOB_MINUTES = 10
+MIN_JOB_MEMORY_MB = 256
+# Seconds between checks for lost jobs when running jobs locally
+JOB_CHECK_INTERVAL = 5
+# Number of values of FORMAT fields that depend on the alleles, used if the
+# vcf header does not define them
+FORMAT_NUMBERS = {'AD': 'R', 'ADF': 'R', 'ADR': 'R', 'GL': 'G', 'GP': 'G',
+                  'PL': 'G'}
 descr = """
 Usage: (1) Run this script with appropriate parameters (2) edit and submit
-SLURM_1.txt to SLURM (3) edit and submit SLURM_2.txt to SLURM (4) manually
-concatenate and sort the output vcf files before downstream use.
+SLURM_1.txt to SLURM (3) edit and submit SLURM_2.txt to SLURM (4) edit and
+submit SLURM_3.txt to SLURM to concatenate the merged parts into a single
+vcf file in reference order.
 
 VCF-files can be merged with vcftools vcf-merge utility or vcflib vcfcombine
 tool. However vcflib vcfcombine consumes a large amount of RAM and is
@@ -23,29 +55,105 @@ path/to/executable input_1.vcf input_2.vcf ... > output.vcf
 Path to appropriate executable is defined with -l parameter
 (-l path/to/executable).
 
+If -l is not given, the parts are merged by this program (-M option, used in
+the scripts of SLURM_2.txt). The sorted part files of all vcf files are read
+simultaneously, so memory use depends only on the number of vcf files.
+Records at the same position are merged into a single record: alleles are
+combined (extending shorter REF alleles when needed) and genotypes are
+re-indexed accordingly. FORMAT fields with a value per allele or genotype
+(Number R, A or G in the header, e.g. AD and PL) are reordered in the same
+way, values of alleles not present in a record are missing (.). Samples
+without a record at the position get missing genotypes (./.). ID, QUAL,
+FILTER and INFO are taken from the first record.
+Records whose REF alleles are incompatible are written separately.
+
 This program assumes that SLURM workload manager is available for use. The
 program takes a directory containing multiple vcf files to be merged as an
 input. User selects in how many parts the vcf files should be divided to.
-Notice that reference genome scaffolds are not split, so each part consists
-of one or more scaffolds. This means that when dealing with non-fragmented
-"good quality" reference genomes only relatively low number of threads can be
-generated. Notice that the input vcf files are expected to contain all
-genotype calls (including monomorphic)!
+By default (-s false) reference genome scaffolds are not split, so each part
+consists of one or more scaffolds. This means that when dealing with
+non-fragmented "good quality" reference genomes only relatively low number of
+threads can be generated in this mode (see -s below). Notice that the input
+vcf files are expected to contain all genotype calls (including monomorphic)!
+
+With -s true scaffolds are split: the reference is cut into -p parts of equal
+size, each part consisting of consecutive intervals of the reference in
+reference order. Scaffolds larger than a part are therefore divided between
+several parts, and any number of parts can be used regardless of the
+assembly quality. Since each part continues where the previous one ended,
+the merged parts are in reference order when concatenated by part number.
+
+The time needed to merge a part depends on the amount of vcf data rather
+than the length of the reference, and variant density varies a lot between
+scaffolds. With -w the parts are balanced by the estimated amount of vcf data
+instead: -w evenly spaced records are read from each input vcf file, and the
+data between consecutive sampled records is assumed to be evenly spread over
+the reference between their positions. This works in both the default and
+the -s true mode and requires the vcf files to be sorted in reference order.
+
+The bed files of the parts are written to the intermediate file directory.
+The file reference_parts.bed lists all intervals in reference order with the
+number of the part containing each interval.
 
 Two SLURM array job files are generated: SLURM_1.txt and SLURM_2.txt. The
 first one contains commands for splitting the input vcf files into n parts
-(i.e. --process_count * [number of vcf files] processes will be created). The
-second SLURM file then merges all samples for each genome part in parallel.
-These files can be found in the output directory. The merged output files
-should be manually concatenated and then sorted before downstream use!
-
-When choosing appropriate process count (-p) notice that array jobs defined
-in SLURM_1.txt creates process_count*number_of_samples parallel jobs.
-SLURM_2.txt creates -p jobs. E.g. with 50 vcf files -p 5 would define 250
-jobs in SLURM_1.txt and 5 jobs in SLURM_2.txt.
-
-Also notice that some SLURM fields in SLURM_1.txt and SLURM_2.txt must be
-manually edited to run the jobs (run time, memory usage etc.)
+(one process per vcf file). The second SLURM file then merges all samples for
+each genome part in parallel. The third SLURM file SLURM_3.txt concatenates
+the merged parts into a single bgzip compressed vcf file combined.vcf.gz in
+the output directory (-d) and indexes it with tabix.
+These files can be found in the output directory.
+
+The concatenation (-C option, used in SLURM_3.txt) does not sort the records:
+the intervals of reference_parts.bed are read in reference order and the
+records of each interval are copied from the merged file of its part, so the
+result is in reference order and has the header of the first part. This
+requires the records of each merged part to be in reference order, which is
+true for the built-in merge. The output of another merge program (-l) may
+have its scaffolds in a different order, so with -l the scaffolds of each
+merged part are first indexed (-i true) and then copied in reference order.
+
+The vcf files are split by this program (-S option, used in the scripts of
+SLURM_1.txt): each vcf file is read once and each record is copied into the
+bgzip compressed file of its part in the input order, so the input vcf files
+must be sorted. The part files are then indexed with tabix. SLURM_1.txt
+creates a job for each vcf file and SLURM_2.txt creates -p jobs. E.g. with 50
+vcf files -p 5 would define 50 jobs in SLURM_1.txt and 5 jobs in SLURM_2.txt.
+
+Instead of submitting the SLURM files, the pipeline can be run on the local
+machine with -L parallel processes (in addition to writing the SLURM
+files). The split and merge jobs are run as a dependency graph: a vcf file
+is split in reference order, so a part is complete once the split has passed
+the last interval of the part, and the merge of a part starts as soon as
+the part is complete in all vcf files. The parts are concatenated once all
+of them have been merged. The environment module (-m) is not
+loaded in this mode, so the programs must be available in PATH.
+
+Scaffold sizes are read from the fasta index (reference path + .fai, see
+samtools faidx) if it exists. Otherwise the reference is scanned for sequence
+lengths without keeping the sequences in memory. With -f true the index is
+written during the scan so that later runs can use it.
+
+The run time and memory fields of the SLURM files can be filled in using a
+calibration table (-c). The table is written by a benchmark run (-B
+calibration.txt with -v, -t and optionally -l), which copies the first 10MB
+of records of each input vcf file into the intermediate file directory and
+times the split, merge and concatenation of these slices. The table contains
+the seconds per MB of input vcf data and the peak memory usage of each step,
+and for the merge also the memory usage per sample, which is estimated by
+merging also only the first half of the slices. The run time of a split job
+is then estimated from the size of its vcf file, the run time of a merge job
+from the estimated vcf data of its part (see -w) or its share of the
+reference, and the run time of the concatenation from the total size of the
+vcf files. The memory of a merge job is estimated from the total number of
+samples. The largest estimate of the jobs of a SLURM file is doubled for a
+safety margin and used for all of its jobs. A partition can be chosen by the
+estimated run time with -q, e.g. -q test=15,small=4320,large=10080 uses the
+first partition with a time limit (minutes) of at least the estimated run
+time. Each job runs a single task.
+
+Also notice that without a calibration table some SLURM fields in
+SLURM_1.txt, SLURM_2.txt and SLURM_3.txt must be manually edited to run the
+jobs (run time, memory usage etc.)
 """
 
 print '\n\nRunning {0} v.{1}, by {2}'.format(NAME, VERSION, AUTHOR)
@@ -62,13 +170,28 @@ parser.add_option('-o', '--output_slurm_files_dir', help='path for slurm files t
 parser.add_option('-d', '--output_final_vcf_dir', help='output path to directory for merged vcf files')
 parser.add_option('-m', '--load_environment_module', help='load an environment module (optional) e.g. -m module___load___mymodule (notice the use of triple underscore characters instead of single whitespace!)')
 
+parser.add_option('-s', '--split_scaffolds', help='split scaffolds to create parts of equal size (true/false, def false)')
+parser.add_option('-w', '--work_samples', help='balance parts by vcf data estimated from this many sampled records per vcf file (e.g. 1000) instead of reference length', type=int)
+parser.add_option('-f', '--write_fai', help='write a fasta index of the reference if it does not exist (true/false, def false)')
+parser.add_option('-C', '--concatenate', help='concatenate the merged parts (in the output directory -d) into this bgzip compressed vcf file in reference order, used by the generated concatenation script')
+parser.add_option('-i', '--index_parts', help='index the scaffolds of the merged parts before concatenation (-C), required if they are not in reference order (true/false, def false)')
+parser.add_option('-c', '--calibration', help='fill the run time and memory fields of the SLURM files using this calibration table (see -B)')
+parser.add_option('-q', '--slurm_partitions', help='SLURM partitions and their time limits in minutes in ascending order for choosing the partition by the estimated run time (requires -c) e.g. -q test=15,small=4320,large=10080')
+parser.add_option('-B', '--benchmark', help='write a calibration table to this file by timing the jobs on slices of the input vcf files (-v) in the intermediate file directory (-t)')
+parser.add_option('-L', '--local_processes', help='run the jobs on this machine using this many parallel processes', type=int)
+parser.add_option('-M', '--merge_part', help='merge the split vcf files (in the intermediate file directory -t) of this part into the output directory (-d), used by the generated merge scripts', type=int)
+parser.add_option('-S', '--split_vcf', help='split this vcf file into the parts defined in the intermediate file directory (-t), used by the generated split scripts')
+
 args = parser.parse_args()[0]
 
 
 def vcfcombineParallelizer(output_final_vcf_dir, reference_path,
                            process_count, output_slurm_files_dir,
                            vcf_file_dir, temp_intermediate_dir, job_name,
-                           vcf_merge_call, load_environment_module):
+                           vcf_merge_call, load_environment_module,
+                           write_fai, split_scaffolds, work_samples,
+                           local_processes, calibration_path,
+                           slurm_partitions):
 
     if (output_final_vcf_dir is None
         or reference_path is None
@@ -76,8 +199,7 @@ def vcfcombineParallelizer(output_final_vcf_dir, reference_path,
         or output_slurm_files_dir is None
         or vcf_file_dir is None
         or temp_intermediate_dir is None
-        or job_name is None
-        or vcf_merge_call is None):
+        or job_name is None):
         print 'Error! At least one input parameter is missing!'
         sys.exit(0)
 
@@ -85,8 +207,38 @@ def vcfcombineParallelizer(output_final_vcf_dir, reference_path,
         load_environment_module = ''
     else:
         load_environment_module = load_environment_module.replace('___', ' ')
+    if write_fai is None or write_fai.lower() in ('f', 'false'):
+        write_fai = False
+    elif write_fai.lower() in ('t', 'true'):
+        write_fai = True
+    else:
+        print 'Error! Odd value for -f parameter. Allowed values are "true" and "false"!'
+        sys.exit(0)
+    if split_scaffolds is None or split_scaffolds.lower() in ('f', 'false'):
+        split_scaffolds = False
+    elif split_scaffolds.lower() in ('t', 'true'):
+        split_scaffolds = True
+    else:
+        print 'Error! Odd value for -s parameter. Allowed values are "true" and "false"!'
+        sys.exit(0)
+    if work_samples is not None and work_samples < 1:
+        print 'Error! Number of sampled records (-w) must be at least 1!'
+        sys.exit(0)
+    if local_processes is not None and local_processes < 1:
+        print 'Error! Number of local processes (-L) must be at least 1!'
+        sys.exit(0)
+    if calibration_path is None:
+        calibration = None
+        if slurm_partitions is not None:
+            print 'Error! Choosing the partition (-q) requires a calibration table (-c)!'
+            sys.exit(0)
+    else:
+        calibration = read_calibration(calibration_path)
+    if slurm_partitions is not None:
+        slurm_partitions = read_slurm_partitions(slurm_partitions)
 
-    vcf_merge_call = vcf_merge_call.replace('___', ' ')
+    if vcf_merge_call is not None:
+        vcf_merge_call = vcf_merge_call.replace('___', ' ')
 
     print '\nUsing parameters:'
     print '-r', reference_path
@@ -98,6 +250,12 @@ def vcfcombineParallelizer(output_final_vcf_dir, reference_path,
     print '-j', job_name
     print '-l', vcf_merge_call
     print '-m', load_environment_module
+    print '-f', write_fai
+    print '-s', split_scaffolds
+    print '-w', work_samples
+    print '-L', local_processes
+    print '-c', calibration_path
+    print '-q', slurm_partitions
 
     # Open output file in good time to make sure it can be created
     try:
@@ -110,95 +268,134 @@ def vcfcombineParallelizer(output_final_vcf_dir, reference_path,
     except:
         print '\n\nERROR! Unable to open output file!\n'
         raise
+    try:
+        out_handle_3 = open(os.path.join(output_slurm_files_dir, 'SLURM_3.txt'), 'w')
+    except:
+        print '\n\nERROR! Unable to open output file!\n'
+        raise
 
     # Identify vcf files
-    vcf_file_names = []
-    for file_name in os.listdir(vcf_file_dir):
-        if not file_name.endswith('.vcf'): continue
-        vcf_file_names.append(file_name)
+    vcf_file_names = list_vcf_files(vcf_file_dir)
     print '\n{0} vcf files found.'.format(len(vcf_file_names))
 
     # Read reference genome
-    print '\nReading reference genome...'
     if not os.path.splitext(reference_path)[-1] in ['.fa', '.fas', '.fasta']:
         print 'Error! Reference file does not seem to be a fasta file!'
         sys.exit(0)
-
-    try:
-        in_handle = open(reference_path)
-    except:
-        print '\n\nError! Unable to open refence genome, reason\n\n'
-        raise
-    reference_sequences = {}
-    reference_sequence_sizes = {}
-    reference_sequence_order = {}
-    first_line = True
-    i = 0
-    for line in in_handle:
-        line = line.strip()
-        if not line: continue
-        if line.startswith('>'):
-            if not first_line:
-                i += 1
-                seq = ''.join(seq)
-                reference_sequences[current_scaffold] = seq
-                reference_sequence_sizes[current_scaffold] = len(seq)
-                reference_sequence_order[current_scaffold] = i
-            current_scaffold = line.split(' ')[0]
-            seq = []
-            first_line = False
-        else:
-            try:
-                seq.append(line)
-            except NameError:
-                print '\n\nError when reading reference file:\n{0}'.format(reference_path)
-                print 'This does not seem like a fasta file, since first line does not contain > ' \
-                      'character!'
-                sys.exit(0)
-    # Include the last scaffold
-    i += 1
-    seq = ''.join(seq)
-    reference_sequences[current_scaffold] = seq
-    reference_sequence_sizes[current_scaffold] = len(seq)
-    reference_sequence_order[current_scaffold] = i
-    in_handle.close()
-    print 'Read {0} scaffolds'.format(len(reference_sequences))
+    reference_sequence_sizes, reference_sequence_order = \
+        read_reference_sizes(reference_path, write_fai)
+    print 'Read {0} scaffolds'.format(len(reference_sequence_sizes))
     print 'Total sequence {0}b'.format(sum(reference_sequence_sizes.values()))
     print 'Largest scaffold contains {0}b'.format(max(reference_sequence_sizes.values()))
 
-    # To balance load between processes (without splitting scaffolds)
+    if work_samples is None:
+        work = None
+    else:
+        print '\nEstimating the distribution of vcf data...'
+        work = work_estimate([os.path.join(vcf_file_dir, vcf_file_name) for
+                              vcf_file_name in vcf_file_names],
+                             reference_sequence_sizes, reference_sequence_order,
+                             work_samples)
+        print 'Estimated {0:.1f}MB of vcf data'.format(work.total_work/1000000)
+
     print '\nSplitting reference genome...'
-    scaffolds_sorted_by_length = sorted(reference_sequence_sizes.items(),
-                                        key=operator.itemgetter(1))
-    scaffolds_sorted_by_length = list(reversed(scaffolds_sorted_by_length))
-    output_scaffold_sets = []
-    output_scaffold_set_sizes = []
-    for scaffold in scaffolds_sorted_by_length:
-        scaffold = scaffold[0]
+    if split_scaffolds:
+        output_part_intervals = split_reference(reference_sequence_sizes,
+                                                reference_sequence_order,
+                                                process_count, work)
+    else:
+        # To balance load between processes (without splitting scaffolds)
+        if work is None:
+            scaffold_weights = reference_sequence_sizes
+        else:
+            scaffold_weights = dict((scaffold, work.interval_work(scaffold, 0, size)) for
+                                    scaffold, size in reference_sequence_sizes.items())
+        scaffolds_sorted_by_length = sorted(scaffold_weights.items(),
+                                            key=operator.itemgetter(1))
+        scaffolds_sorted_by_length = list(reversed(scaffolds_sorted_by_length))
+        output_scaffold_sets = []
+        output_scaffold_set_sizes = []
+        for scaffold in scaffolds_sorted_by_length:
+            scaffold = scaffold[0]
+            if len(output_scaffold_sets) < process_count:
+                output_scaffold_sets.append([scaffold])
+                output_scaffold_set_sizes.append(scaffold_weights[scaffold])
+            else:
+                output_index = output_scaffold_set_sizes.index(min(output_scaffold_set_sizes))
+                output_scaffold_sets[output_index].append(scaffold)
+                output_scaffold_set_sizes[output_index] += scaffold_weights[scaffold]
         if len(output_scaffold_sets) < process_count:
-            output_scaffold_sets.append([scaffold])
-            output_scaffold_set_sizes.append(reference_sequence_sizes[scaffold])
+            print 'Error! The reference contains only {0} scaffolds, use -s true ' \
+                  'to split scaffolds into {1} parts!'.format(len(output_scaffold_sets),
+                                                            process_count)
+            sys.exit(0)
+        output_part_intervals = []
+        for scaffold_set in output_scaffold_sets:
+            scaffold_set = sorted(scaffold_set, key=reference_sequence_order.get)
+            output_part_intervals.append([(scaffold, 0, reference_sequence_sizes[scaffold]) for
+                                          scaffold in scaffold_set])
+    part_sizes = [sum(end - start for scaffold, start, end in intervals) for
+                  intervals in output_part_intervals]
+    print 'Part sizes range from {0}b to {1}b'.format(min(part_sizes),
+                                                      max(part_sizes))
+    if work is not None:
+        part_work = [sum(work.interval_work(*interval) for interval in intervals) for
+                     intervals in output_part_intervals]
+        print 'Estimated vcf data of parts ranges from {0:.1f}MB to {1:.1f}MB'.format(min(part_work)/1000000,
+                                                                                   max(part_work)/1000000)
+
+    if calibration is None:
+        split_resources = merge_resources = concatenate_resources = None
+    else:
+        print '\nEstimating job resources...'
+        vcf_file_paths = [os.path.join(vcf_file_dir, vcf_file_name) for
+                          vcf_file_name in vcf_file_names]
+        vcf_file_sizes = [os.path.getsize(vcf_file_path) for
+                          vcf_file_path in vcf_file_paths]
+        sample_counts = [count_samples(vcf_file_path) for
+                         vcf_file_path in vcf_file_paths]
+        if work is None:
+            # vcf data is assumed to be evenly spread over the reference
+            part_data = [float(sum(vcf_file_sizes)) * part_size / sum(part_sizes) for
+                         part_size in part_sizes]
         else:
-            output_index = output_scaffold_set_sizes.index(min(output_scaffold_set_sizes))
-            output_scaffold_sets[output_index].append(scaffold)
-            output_scaffold_set_sizes[output_index] += reference_sequence_sizes[scaffold]
-    assert len(output_scaffold_sets) == process_count
+            part_data = part_work
+        # The jobs of an array job file get the largest estimates
+        split_resources = [estimate_resources(calibration, 'split', size, samples) for
+                           size, samples in zip(vcf_file_sizes, sample_counts)]
+        split_resources = map(max, zip(*split_resources))
+        merge_resources = [estimate_resources(calibration, 'merge', data,
+                                              sum(sample_counts)) for
+                           data in part_data]
+        merge_resources = map(max, zip(*merge_resources))
+        concatenate_resources = estimate_resources(calibration, 'concatenate',
+                                                   sum(vcf_file_sizes),
+                                                   sum(sample_counts))
+        for step, resources in (('split', split_resources),
+                                ('merge', merge_resources),
+                                ('concatenation', concatenate_resources)):
+            print 'Estimated {0} job: {1} minutes, {2}MB'.format(step,
+                                                                resources[0],
+                                                                resources[1])
 
     # Generate bed file for each fragment
     print 'Generating bed files for reference genome parts...'
     bed_file_path_list = []
     i = 0
-    for scaffold_set in output_scaffold_sets:
+    for intervals in output_part_intervals:
         i += 1
         bed_file_path = 'output_scaffold_set_{0}.bed'.format(i)
         bed_file_path = os.path.join(temp_intermediate_dir, bed_file_path)
         bed_file_path_list.append(bed_file_path)
         bed_out_handle = open(bed_file_path, 'w')
         bed_out_handle.write('#CHROM\tSTART\tEND\n')
-        for scaffold in scaffold_set:
-            bed_out_handle.write('\t'.join(map(str, [scaffold[1:], 0, reference_sequence_sizes[scaffold]])))
+        for interval in intervals:
+            bed_out_handle.write('\t'.join(map(str, interval)))
             bed_out_handle.write('\n')
         bed_out_handle.close()
+    write_reference_parts(os.path.join(temp_intermediate_dir,
+                                       'reference_parts.bed'),
+                          output_part_intervals, reference_sequence_order)
 
     print '\nWriting shellscripts...'
     # Write array job file for splitting vcf files to parts based on bed files
@@ -206,11 +403,8 @@ def vcfcombineParallelizer(output_final_vcf_dir, reference_path,
     out_handle_1.write('#SBATCH --error={0}_%A_%a.err\n'.format(job_name))
     out_handle_1.write('#SBATCH --output={0}_%A_%a.out\n'.format(job_name))
     out_handle_1.write('#SBATCH --job-name={0}\n'.format(job_name))
-    out_handle_1.write('#SBATCH --array={0}-{1}\n'.format(1, process_count*len(vcf_file_names)))
-    out_handle_1.write('#SBATCH --time=\n')
-    out_handle_1.write('#SBATCH --partition=\n')
-    out_handle_1.write('#SBATCH --ntasks=\n')
-    out_handle_1.write('#SBATCH --mem-per-cpu=\n')
+    out_handle_1.write('#SBATCH --array={0}-{1}\n'.format(1, len(vcf_file_names)))
+    write_slurm_resources(out_handle_1, split_resources, slurm_partitions)
 
     out_handle_1.write('\n\n')
     file_path = '{0}_split_subshell.sh'.format('"$SLURM_ARRAY_TASK_ID"')
@@ -224,10 +418,7 @@ def vcfcombineParallelizer(output_final_vcf_dir, reference_path,
     out_handle_2.write('#SBATCH --output={0}_%A_%a.out\n'.format(job_name))
     out_handle_2.write('#SBATCH --job-name={0}\n'.format(job_name))
     out_handle_2.write('#SBATCH --array={0}-{1}\n'.format(1, process_count))
-    out_handle_2.write('#SBATCH --time=\n')
-    out_handle_2.write('#SBATCH --partition=\n')
-    out_handle_2.write('#SBATCH --ntasks=\n')
-    out_handle_2.write('#SBATCH --mem-per-cpu=\n')
+    write_slurm_resources(out_handle_2, merge_resources, slurm_partitions)
 
     out_handle_2.write('\n\n')
     file_path = '{0}_merge_subshell.sh'.format('"$SLURM_ARRAY_TASK_ID"')
@@ -235,50 +426,1230 @@ def vcfcombineParallelizer(output_final_vcf_dir, reference_path,
     out_handle_2.write('source {0}\n'.format(file_path))
     out_handle_2.close()
 
+    # Write job file for concatenating the merged parts
+    out_handle_3.write('#!/bin/sh\n')
+    out_handle_3.write('#SBATCH --error={0}_%j.err\n'.format(job_name))
+    out_handle_3.write('#SBATCH --output={0}_%j.out\n'.format(job_name))
+    out_handle_3.write('#SBATCH --job-name={0}\n'.format(job_name))
+    write_slurm_resources(out_handle_3, concatenate_resources, slurm_partitions)
+
+    out_handle_3.write('\n\n')
+    file_path = os.path.join(output_slurm_files_dir, 'concatenate_subshell.sh')
+    out_handle_3.write('source {0}\n'.format(file_path))
+    out_handle_3.close()
+
+    script_call = '{0} {1}'.format(sys.executable, os.path.abspath(__file__))
     current_split_file_number = 0
+    for vcf_file_name in vcf_file_names:
+        vcf_file_path = os.path.join(vcf_file_dir, vcf_file_name)
+        current_split_file_number += 1
+        out_slurm_subscript_path = '{0}_split_subshell.sh'.format(current_split_file_number)
+        out_slurm_subscript_path = os.path.join(output_slurm_files_dir, out_slurm_subscript_path)
+        out_handle = open(out_slurm_subscript_path, 'w')
+        out_handle.write('{0}\n'.format(load_environment_module))
+        out_handle.write('{0} -S {1} -t {2}\n'.format(script_call,
+                                                     vcf_file_path,
+                                                     temp_intermediate_dir))
+        for part_number in range(1, process_count + 1):
+            out_handle.write('tabix -p vcf {0}\n'.format(part_vcf_path(temp_intermediate_dir,
+                                                                       part_number,
+                                                                       vcf_file_name)))
+        out_handle.close()
+
     current_merge_file_number = 0
     for bed_file_path in bed_file_path_list:
         current_merge_file_number += 1
-        files_to_merge = []
-        for vcf_file_name in vcf_file_names:
-            vcf_file_path = os.path.join(vcf_file_dir, vcf_file_name)
-            current_split_file_number += 1
-            out_slurm_subscript_path = '{0}_split_subshell.sh'.format(current_split_file_number)
-            out_slurm_subscript_path = os.path.join(output_slurm_files_dir, out_slurm_subscript_path)
-            out_split_vcf_file_path = os.path.join(temp_intermediate_dir,
-                                                   '{0}_{1}'.format(current_split_file_number, vcf_file_name))
-            out_handle = open(out_slurm_subscript_path, 'w')
-            out_handle.write('{0}\n'.format(load_environment_module))
-            out_handle.write('vcftools --recode --vcf {0} --bed {1} --stdout > {2}\n'
-                             .format(vcf_file_path,
-                                     bed_file_path,
-                                     out_split_vcf_file_path))
-            out_handle.write('grep "#" {0} > {1}\n'.format(os.path.join(temp_intermediate_dir, out_split_vcf_file_path),
-                                                         os.path.join(temp_intermediate_dir, out_split_vcf_file_path + '_sorted.vcf')))
-            out_handle.write('grep -v "#" {0} | sort -k1,1V -k2,2n >> {1}\n'.format(os.path.join(temp_intermediate_dir, out_split_vcf_file_path),
-                                                                      os.path.join(temp_intermediate_dir, out_split_vcf_file_path + '_sorted.vcf')))
-
-            out_handle.write('bgzip -c {0} > {0}.gz\n'.format(os.path.join(temp_intermediate_dir, out_split_vcf_file_path + '_sorted.vcf')))
-            out_handle.write('tabix {0}.gz\n'.format(os.path.join(temp_intermediate_dir, out_split_vcf_file_path + '_sorted.vcf')))
-
-            out_handle.close()
-            files_to_merge.append(os.path.join(temp_intermediate_dir, out_split_vcf_file_path + '_sorted.vcf.gz'))
+        files_to_merge = [part_vcf_path(temp_intermediate_dir,
+                                        current_merge_file_number,
+                                        vcf_file_name) for
+                          vcf_file_name in vcf_file_names]
         out_handle = open(os.path.join(output_slurm_files_dir,
                                        '{0}_merge_subshell.sh'.format(str(current_merge_file_number))),'w')
         out_handle.write('{0}\n'.format(load_environment_module))
-        out_handle.write('{0} {1} > {2}\n'.format(vcf_merge_call,
-                                                  ' '.join(files_to_merge),
-                                                  os.path.join(output_final_vcf_dir, str(current_merge_file_number) + '.vcf')))
+        if vcf_merge_call is None:
+            out_handle.write('{0} -M {1} -v {2} -t {3} -d {4}\n'.format(script_call,
+                                                                      current_merge_file_number,
+                                                                      vcf_file_dir,
+                                                                      temp_intermediate_dir,
+                                                                      output_final_vcf_dir))
+        else:
+            out_handle.write('{0} {1} > {2}\n'.format(vcf_merge_call,
+                                                      ' '.join(files_to_merge),
+                                                      os.path.join(output_final_vcf_dir, str(current_merge_file_number) + '.vcf')))
         out_handle.close()
+
+    combined_vcf_path = os.path.join(output_final_vcf_dir, 'combined.vcf.gz')
+    out_handle = open(os.path.join(output_slurm_files_dir,
+                                   'concatenate_subshell.sh'), 'w')
+    out_handle.write('{0}\n'.format(load_environment_module))
+    out_handle.write('{0} -C {1} -t {2} -d {3} -i {4}\n'.format(script_call,
+                                                               combined_vcf_path,
+                                                               temp_intermediate_dir,
+                                                               output_final_vcf_dir,
+                                                               str(vcf_merge_call is not None).lower()))
+    out_handle.write('tabix -p vcf {0}\n'.format(combined_vcf_path))
+    out_handle.close()
+
+    if local_processes is not None:
+        run_local(vcf_file_dir, vcf_file_names, process_count,
+                  temp_intermediate_dir, output_final_vcf_dir, vcf_merge_call,
+                  combined_vcf_path, local_processes)
     print '\nProgram run successful!'
 
 
-vcfcombineParallelizer(args.output_final_vcf_dir,
-                       args.reference_path,
-                       args.process_count,
-                       args.output_slurm_files_dir,
-                       args.input_vcf_file_dir,
-                       args.temp_intermediate_dir,
-                       args.job_name,
-                       args.vcf_merge_call,
-                       args.load_environment_module)
+def write_slurm_resources(out_handle, resources, slurm_partitions):
+    """Writes the resource fields of a SLURM file. resources is an
+    (minutes, memory MB) pair, the fields are left empty if it is None."""
+    if resources is None:
+        out_handle.write('#SBATCH --time=\n')
+        out_handle.write('#SBATCH --partition=\n')
+        out_handle.write('#SBATCH --ntasks=\n')
+        out_handle.write('#SBATCH --mem-per-cpu=\n')
+        return
+    minutes, memory = resources
+    partition = ''
+    if slurm_partitions is not None:
+        for partition, time_limit in slurm_partitions:
+            if time_limit >= minutes: break
+        else:
+            print 'Warning! The estimated run time {0} minutes exceeds the time ' \
+                  'limits of all partitions!'.format(minutes)
+            minutes = time_limit
+    out_handle.write('#SBATCH --time={0}-{1:02d}:{2:02d}:00\n'.format(minutes / 1440,
+                                                                   minutes % 1440 / 60,
+                                                                   minutes % 60))
+    out_handle.write('#SBATCH --partition={0}\n'.format(partition))
+    out_handle.write('#SBATCH --ntasks=1\n')
+    out_handle.write('#SBATCH --mem-per-cpu={0}M\n'.format(memory))
+
+
+def read_slurm_partitions(slurm_partitions):
+    """Returns a list of (partition, time limit in minutes) pairs"""
+    partitions = []
+    for partition in slurm_partitions.split(','):
+        try:
+            name, time_limit = partition.split('=')
+            partitions.append((name, int(time_limit)))
+        except ValueError:
+            print 'Error! Odd value for -q parameter: {0}. Partitions should be ' \
+                  'given as name=minutes pairs separated by commas!'.format(partition)
+            sys.exit(0)
+    return partitions
+
+
+def read_calibration(calibration_path):
+    """Returns a dict with the (seconds per MB, memory MB, memory MB per
+    sample) of each step of a calibration table"""
+    calibration = {}
+    try:
+        in_handle = open(calibration_path)
+    except IOError:
+        print 'Error! Unable to open calibration table {0}!'.format(calibration_path)
+        sys.exit(0)
+    for line in in_handle:
+        if line.startswith('#'): continue
+        line = line.split()
+        if not line: continue
+        calibration[line[0]] = tuple(map(float, line[1:4]))
+    in_handle.close()
+    for step in ('split', 'merge', 'concatenate'):
+        if step not in calibration:
+            print 'Error! Calibration table {0} does not contain the {1} ' \
+                  'step!'.format(calibration_path, step)
+            sys.exit(0)
+    return calibration
+
+
+def estimate_resources(calibration, step, data_bytes, samples):
+    """Returns the estimated (minutes, memory MB) of a job with the safety
+    margin"""
+    seconds_per_mb, memory, memory_per_sample = calibration[step]
+    minutes = seconds_per_mb * data_bytes / 1000000 / 60 * ESTIMATE_MARGIN
+    memory = (memory + memory_per_sample * samples) * ESTIMATE_MARGIN
+    return (max(MIN_JOB_MINUTES, int(minutes) + 1),
+            max(MIN_JOB_MEMORY_MB, int(memory) + 1))
+
+
+def count_samples(vcf_file_path):
+    """Returns the number of samples in the header of a vcf file"""
+    in_handle = open_vcf(vcf_file_path)
+    for line in in_handle:
+        if line.startswith('#CHROM'):
+            in_handle.close()
+            return len(line.rstrip('\r\n').split('\t')[9:])
+        if not line.startswith('#'): break
+    in_handle.close()
+    print 'Error! No header line found in {0}!'.format(vcf_file_path)
+    sys.exit(0)
+
+
+def benchmark(calibration_path, vcf_file_dir, temp_intermediate_dir,
+              vcf_merge_call):
+    """Times the split, merge and concatenation jobs on slices of the
+    input vcf files and writes the calibration table"""
+    if vcf_file_dir is None or temp_intermediate_dir is None:
+        print 'Error! Input vcf file directory (-v) and intermediate file ' \
+              'directory (-t) are required with -B!'
+        sys.exit(0)
+    if vcf_merge_call is not None:
+        vcf_merge_call = vcf_merge_call.replace('___', ' ')
+    vcf_file_names = list_vcf_files(vcf_file_dir)
+    if not vcf_file_names:
+        print 'Error! No vcf files found in {0}!'.format(vcf_file_dir)
+        sys.exit(0)
+    benchmark_dir = os.path.join(temp_intermediate_dir, 'benchmark')
+    slice_dir = os.path.join(benchmark_dir, 'vcf')
+    half_slice_dir = os.path.join(benchmark_dir, 'vcf_half')
+    if os.path.isdir(benchmark_dir):
+        shutil.rmtree(benchmark_dir)
+    os.makedirs(slice_dir)
+    os.makedirs(half_slice_dir)
+
+    print '\nCopying slices of {0} vcf files...'.format(len(vcf_file_names))
+    # The slices are treated as a single part covering all of their records
+    scaffold_ends = OrderedDict()
+    slice_sizes = []
+    sample_counts = []
+    for vcf_file_name in vcf_file_names:
+        in_handle = open(os.path.join(vcf_file_dir, vcf_file_name))
+        out_handle = open(os.path.join(slice_dir, vcf_file_name), 'w')
+        slice_size = 0
+        for line in in_handle:
+            out_handle.write(line)
+            if line.startswith('#'):
+                if line.startswith('#CHROM'):
+                    sample_counts.append(len(line.rstrip('\r\n').split('\t')[9:]))
+                continue
+            slice_size += len(line)
+            scaffold, pos = line.split('\t', 2)[:2]
+            scaffold_ends[scaffold] = max(scaffold_ends.get(scaffold, 0), int(pos))
+            if slice_size >= BENCHMARK_SLICE_SIZE: break
+        in_handle.close()
+        out_handle.close()
+        slice_sizes.append(slice_size)
+    # The memory usage per sample is estimated by merging also only the first
+    # half of the slices
+    half_vcf_file_names = vcf_file_names[:(len(vcf_file_names) + 1) / 2]
+    for vcf_file_name in half_vcf_file_names:
+        os.symlink(os.path.abspath(os.path.join(slice_dir, vcf_file_name)),
+                   os.path.join(half_slice_dir, vcf_file_name))
+    write_reference_parts(os.path.join(benchmark_dir, 'reference_parts.bed'),
+                          [[(scaffold, 0, end) for scaffold, end in scaffold_ends.items()]],
+                          dict((scaffold, i) for i, scaffold in enumerate(scaffold_ends)))
+    total_mb = sum(slice_sizes) / 1000000.0
+    if not total_mb:
+        print 'Error! No records found in the vcf files!'
+        sys.exit(0)
+    half_samples = sum(sample_counts[:len(half_vcf_file_names)])
+    print 'Copied {0:.1f}MB of records.'.format(total_mb)
+
+    script_call = '{0} {1}'.format(sys.executable, os.path.abspath(__file__))
+    print '\nTiming split jobs...'
+    split_seconds = 0.0
+    split_memory = 0.0
+    for vcf_file_name in vcf_file_names:
+        seconds, memory = run_timed('{0} -S {1} -t {2}'.format(script_call,
+                                                              os.path.join(slice_dir, vcf_file_name),
+                                                              benchmark_dir))
+        split_seconds += seconds
+        split_memory = max(split_memory, memory)
+
+    print 'Timing merge jobs...'
+    merge_runs = []
+    for merge_dir, merge_vcf_file_names in ((half_slice_dir, half_vcf_file_names),
+                                            (slice_dir, vcf_file_names)):
+        if vcf_merge_call is None:
+            command = '{0} -M 1 -v {1} -t {2} -d {2}'.format(script_call,
+                                                             merge_dir,
+                                                             benchmark_dir)
+        else:
+            files_to_merge = ' '.join(part_vcf_path(benchmark_dir, 1, vcf_file_name) for
+                                      vcf_file_name in merge_vcf_file_names)
+            command = 'for f in {0}; do tabix -f -p vcf $f || exit 1; done; ' \
+                      '{1} {0} > {2}'.format(files_to_merge, vcf_merge_call,
+                                             os.path.join(benchmark_dir, '1.vcf'))
+        merge_runs.append(run_timed(command))
+    half_memory = merge_runs[0][1]
+    merge_seconds, merge_memory = merge_runs[1]
+    if sum(sample_counts) > half_samples:
+        memory_per_sample = max(0.0, (merge_memory - half_memory) /
+                                (sum(sample_counts) - half_samples))
+    else:
+        memory_per_sample = 0.0
+    merge_base_memory = max(0.0, merge_memory - memory_per_sample * sum(sample_counts))
+
+    print 'Timing concatenation job...'
+    concatenate_seconds, concatenate_memory = run_timed(
+        '{0} -C {1} -t {2} -d {2} -i {3}'.format(script_call,
+                                                 os.path.join(benchmark_dir, 'combined.vcf.gz'),
+                                                 benchmark_dir,
+                                                 str(vcf_merge_call is not None).lower()))
+
+    out_handle = open(calibration_path, 'w')
+    out_handle.write('#STEP\tSECONDS_PER_MB\tMEMORY_MB\tMEMORY_MB_PER_SAMPLE\n')
+    for step, seconds_per_mb, memory, per_sample in (
+            ('split', split_seconds / total_mb, split_memory, 0.0),
+            ('merge', merge_seconds / total_mb, merge_base_memory,
+             memory_per_sample),
+            ('concatenate', concatenate_seconds / total_mb, concatenate_memory, 0.0)):
+        out_handle.write('{0}\t{1:.4f}\t{2:.1f}\t{3:.4f}\n'.format(step, seconds_per_mb,
+                                                                  memory,
+                                                                  per_sample))
+    out_handle.close()
+    print 'Wrote calibration table {0}'.format(calibration_path)
+
+
+def run_timed(command):
+    """Runs a shell command and returns its run time in seconds and peak
+    memory usage in MB"""
+    devnull = open(os.devnull, 'w')
+    start_time = time.time()
+    process = subprocess.Popen(command, shell=True, stdout=devnull)
+    # The resource usage of wait4 includes the children of the shell
+    status, resource_usage = os.wait4(process.pid, 0)[1:]
+    seconds = time.time() - start_time
+    devnull.close()
+    if status:
+        print 'Error! Command failed: {0}'.format(command)
+        sys.exit(0)
+    # ru_maxrss is given in kilobytes
+    return seconds, resource_usage.ru_maxrss / 1000.0
+
+
+def split_reference(reference_sequence_sizes, reference_sequence_order,
+                    process_count, work):
+    """Splits the reference into process_count parts of (almost) equal size,
+    or of equal estimated work if a work_estimate is given. Returns a list of
+    (scaffold, start, end) intervals (bed coordinates) for each part. The
+    parts are consecutive stretches of the reference in reference order."""
+    total_size = sum(reference_sequence_sizes.values())
+    if total_size < process_count:
+        print 'Error! The reference is too short for {0} parts!'.format(process_count)
+        sys.exit(0)
+    if work is None:
+        part_ends = [(i + 1) * total_size / process_count for i in range(process_count)]
+    else:
+        part_ends = [work.position_at(work.total_work * (i + 1) / process_count) for
+                     i in range(process_count - 1)] + [total_size]
+        # Every part must contain at least one base
+        for i in range(process_count):
+            part_ends[i] = min(max(part_ends[i], part_ends[i-1] + 1 if i else 1),
+                               total_size - (process_count - i - 1))
+    output_part_intervals = [[] for i in range(process_count)]
+    part_index = 0
+    # Position of the current scaffold start in the concatenated reference
+    offset = 0
+    for scaffold in sorted(reference_sequence_sizes,
+                           key=reference_sequence_order.get):
+        size = reference_sequence_sizes[scaffold]
+        start = 0
+        while start < size:
+            part_end = part_ends[part_index]
+            end = min(size, part_end - offset)
+            if end > start:
+                output_part_intervals[part_index].append((scaffold, start, end))
+                start = end
+            if offset + start >= part_end:
+                part_index += 1
+        offset += size
+    return output_part_intervals
+
+
+class work_estimate:
+    """Estimates the distribution of vcf data (bytes) over the reference by
+    reading samples_per_file evenly spaced records of each vcf file. Positions
+    are coordinates of the reference concatenated in reference order. The
+    data between consecutive sampled records is assumed to be evenly spread
+    between their positions, so the cumulative work is piecewise linear."""
+    def __init__(self, vcf_file_paths, reference_sequence_sizes,
+                 reference_sequence_order, samples_per_file):
+        self.reference_sequence_sizes = reference_sequence_sizes
+        self.scaffold_offsets = {}
+        offset = 0
+        for scaffold in sorted(reference_sequence_sizes,
+                               key=reference_sequence_order.get):
+            self.scaffold_offsets[scaffold] = offset
+            offset += reference_sequence_sizes[scaffold]
+        self.total_size = offset
+
+        samples = []
+        for vcf_file_path in vcf_file_paths:
+            samples += self.sample_vcf_file(vcf_file_path, samples_per_file)
+        samples.sort()
+        # Breakpoints of the cumulative work function
+        self.positions = [0]
+        self.work = [0.0]
+        for position, sample_bytes in samples:
+            self.positions.append(position)
+            self.work.append(self.work[-1] + sample_bytes)
+        self.positions.append(self.total_size)
+        self.work.append(self.work[-1])
+        self.total_work = self.work[-1]
+        if not self.total_work:
+            print 'Error! No records of the reference scaffolds found in the vcf files!'
+            sys.exit(0)
+
+    def sample_vcf_file(self, vcf_file_path, samples_per_file):
+        """Returns (position, bytes) pairs of the sampled records"""
+        in_handle = open(vcf_file_path)
+        data_start = 0
+        while True:
+            line = in_handle.readline()
+            if not line.startswith('#'): break
+            data_start += len(line)
+        in_handle.seek(0, os.SEEK_END)
+        sample_bytes = float(in_handle.tell() - data_start) / samples_per_file
+        samples = []
+        for i in range(samples_per_file):
+            in_handle.seek(data_start + int(i * sample_bytes))
+            if i:
+                # Skip the partial line
+                in_handle.readline()
+            line = in_handle.readline().split('\t', 2)
+            if len(line) < 3 or line[0] not in self.scaffold_offsets:
+                continue
+            try:
+                position = min(int(line[1]), self.reference_sequence_sizes[line[0]])
+            except ValueError:
+                continue
+            samples.append((self.scaffold_offsets[line[0]] + position,
+                            sample_bytes))
+        in_handle.close()
+        return samples
+
+    def work_at(self, position):
+        """Returns the estimated work before position"""
+        i = bisect_right(self.positions, position)
+        if i == len(self.positions):
+            return self.total_work
+        return self.work[i-1] + (self.work[i] - self.work[i-1]) * \
+            (position - self.positions[i-1]) / (self.positions[i] - self.positions[i-1])
+
+    def position_at(self, work):
+        """Returns the position where the estimated work reaches work"""
+        i = bisect_left(self.work, work)
+        if i == 0:
+            return 0
+        if i == len(self.work):
+            return self.total_size
+        return int(round(self.positions[i-1] + (self.positions[i] - self.positions[i-1]) *
+                         (work - self.work[i-1]) / (self.work[i] - self.work[i-1])))
+
+    def interval_work(self, scaffold, start, end):
+        offset = self.scaffold_offsets[scaffold]
+        return self.work_at(offset + end) - self.work_at(offset + start)
+
+
+def write_reference_parts(out_path, output_part_intervals,
+                          reference_sequence_order):
+    """Writes all intervals in reference order with their part numbers"""
+    intervals = []
+    for part_number, part_intervals in enumerate(output_part_intervals, 1):
+        for scaffold, start, end in part_intervals:
+            intervals.append((reference_sequence_order[scaffold], start, end,
+                              scaffold, part_number))
+    intervals.sort()
+    out_handle = open(out_path, 'w')
+    out_handle.write('#CHROM\tSTART\tEND\tPART\n')
+    for order, start, end, scaffold, part_number in intervals:
+        out_handle.write('{0}\t{1}\t{2}\t{3}\n'.format(scaffold, start, end,
+                                                        part_number))
+    out_handle.close()
+
+
+def list_vcf_files(vcf_file_dir):
+    """Returns the names of the vcf files of a directory in sorted order"""
+    return sorted(file_name for file_name in os.listdir(vcf_file_dir) if
+                  file_name.endswith('.vcf'))
+
+
+def part_vcf_path(temp_intermediate_dir, part_number, vcf_file_name):
+    """Returns the path of the part of a vcf file"""
+    return os.path.join(temp_intermediate_dir,
+                        'part_{0}_{1}.gz'.format(part_number, vcf_file_name))
+
+
+def read_reference_parts(reference_parts_path):
+    """Returns the number of parts, a dict with a list of (start, end, part
+    number) intervals of each scaffold and a dict with the reference order
+    of each scaffold"""
+    scaffold_intervals = {}
+    scaffold_order = {}
+    part_count = 0
+    in_handle = open(reference_parts_path)
+    for line in in_handle:
+        if line.startswith('#'): continue
+        line = line.split()
+        if not line: continue
+        part_number = int(line[3])
+        if line[0] not in scaffold_order:
+            scaffold_order[line[0]] = len(scaffold_order)
+        scaffold_intervals.setdefault(line[0], []).append((int(line[1]),
+                                                           int(line[2]),
+                                                           part_number))
+        part_count = max(part_count, part_number)
+    in_handle.close()
+    return part_count, scaffold_intervals, scaffold_order
+
+
+def split_vcf(vcf_file_path, temp_intermediate_dir, part_finished=None):
+    """Copies the records of a vcf file into bgzip compressed part files
+    according to the reference_parts.bed file of the intermediate file
+    directory. Each part file gets the header of the vcf file.
+
+    If part_finished is given, the vcf file must be sorted in reference
+    order: a part file is then completed as soon as the records have passed
+    the last interval of the part, and part_finished is called with the part
+    number. Otherwise only the records of each scaffold need to be sorted and
+    the part files are completed at the end of the vcf file.
+    """
+    if temp_intermediate_dir is None:
+        print 'Error! Intermediate file directory (-t) is required with -S!'
+        sys.exit(0)
+    part_count, scaffold_intervals, scaffold_order = read_reference_parts(
+        os.path.join(temp_intermediate_dir, 'reference_parts.bed'))
+    # Interval ends of each scaffold for finding the interval of a position
+    scaffold_interval_ends = dict((scaffold, [end for start, end, part_number in intervals]) for
+                                  scaffold, intervals in scaffold_intervals.items())
+    # The (scaffold order, end) of the last interval of each part, sorted
+    part_ends = {}
+    for scaffold, intervals in scaffold_intervals.items():
+        for start, end, part_number in intervals:
+            part_ends[part_number] = max(part_ends.get(part_number, (-1, 0)),
+                                         (scaffold_order[scaffold], end))
+    part_ends = sorted((end, part_number) for part_number, end in part_ends.items())
+    next_part_end = 0
+    vcf_file_name = os.path.basename(vcf_file_path)
+    print '\nSplitting {0} into {1} parts...'.format(vcf_file_path, part_count)
+
+    in_handle = open(vcf_file_path)
+    header = []
+    writers = {}
+    open_writers = OrderedDict()
+    finished_parts = set()
+    records = 0
+    skipped_records = 0
+    current_scaffold = None
+    # The current interval (bed coordinates) and its part
+    current_start = current_end = 0
+    current_part = None
+    for line in in_handle:
+        if line.startswith('#'):
+            header.append(line)
+            continue
+        records += 1
+        scaffold, pos = line.split('\t', 2)[:2]
+        pos = int(pos)
+        if scaffold != current_scaffold or not current_start < pos <= current_end:
+            current_scaffold = scaffold
+            current_start = current_end = 0
+            intervals = scaffold_intervals.get(scaffold)
+            if intervals is None:
+                skipped_records += 1
+                continue
+            while part_finished is not None and next_part_end < len(part_ends) and \
+                    (scaffold_order[scaffold], pos) > part_ends[next_part_end][0]:
+                part_number = part_ends[next_part_end][1]
+                finish_part_file(writers, open_writers, part_number,
+                                 temp_intermediate_dir, vcf_file_name, header)
+                finished_parts.add(part_number)
+                part_finished(part_number)
+                next_part_end += 1
+            i = bisect_left(scaffold_interval_ends[scaffold], pos)
+            if i == len(intervals) or intervals[i][0] >= pos:
+                skipped_records += 1
+                continue
+            current_start, current_end, part_number = intervals[i]
+            if part_number in finished_parts:
+                print 'Error! Vcf file {0} is not sorted in reference order ' \
+                      'at {1}:{2}!'.format(vcf_file_path, scaffold, pos)
+                sys.exit(1)
+            if part_number != current_part:
+                current_part = part_number
+                if current_part not in writers:
+                    writers[current_part] = bgzf_writer(part_vcf_path(temp_intermediate_dir,
+                                                                      current_part,
+                                                                      vcf_file_name))
+                    writers[current_part].write(''.join(header))
+                else:
+                    open_writers.pop(current_part, None)
+                if len(open_writers) >= MAX_OPEN_FILES:
+                    open_writers.popitem(last=False)[1].suspend()
+                open_writers[current_part] = writers[current_part]
+        writers[current_part].write(line)
+    in_handle.close()
+
+    for end, part_number in part_ends[next_part_end:]:
+        finish_part_file(writers, open_writers, part_number,
+                         temp_intermediate_dir, vcf_file_name, header)
+        if part_finished is not None:
+            part_finished(part_number)
+    print 'Split {0} records.'.format(records - skipped_records)
+    if skipped_records:
+        print 'Warning! {0} records outside the reference parts were ' \
+              'skipped!'.format(skipped_records)
+
+
+def finish_part_file(writers, open_writers, part_number, temp_intermediate_dir,
+                     vcf_file_name, header):
+    """Closes a part file. Parts without records get only the header."""
+    if part_number not in writers:
+        writers[part_number] = bgzf_writer(part_vcf_path(temp_intermediate_dir,
+                                                        part_number,
+                                                        vcf_file_name))
+        writers[part_number].write(''.join(header))
+    writers[part_number].close()
+    open_writers.pop(part_number, None)
+
+
+def run_local(vcf_file_dir, vcf_file_names, process_count,
+              temp_intermediate_dir, output_final_vcf_dir, vcf_merge_call,
+              combined_vcf_path, local_processes):
+    """Runs the split, merge and concatenation jobs with a pool of
+    local_processes processes. The merge of a part is started when all vcf
+    files have finished splitting the part, and the parts are concatenated
+    when all of them have been merged."""
+    if not vcf_file_names:
+        print 'Error! No vcf files found in {0}!'.format(vcf_file_dir)
+        sys.exit(1)
+    print '\nRunning jobs locally using {0} processes...'.format(local_processes)
+    manager = multiprocessing.Manager()
+    # Jobs report their progress as (event, value) pairs
+    events = manager.Queue()
+    pool = multiprocessing.Pool(local_processes)
+    # The AsyncResult of each job and the process id of each started job.
+    # Jobs are identified by (step, vcf file index or part number).
+    job_results = {}
+    job_processes = {}
+    try:
+        for i, vcf_file_name in enumerate(vcf_file_names):
+            job_results[('split', i)] = pool.apply_async(
+                run_split_job, (os.path.join(vcf_file_dir, vcf_file_name),
+                                temp_intermediate_dir, i, events))
+        # Number of vcf files that have finished each part
+        split_parts = [0] * (process_count + 1)
+        merged_parts = 0
+        while job_results:
+            try:
+                event, value = events.get(timeout=JOB_CHECK_INTERVAL)
+            except Queue.Empty:
+                check_local_jobs(job_results, job_processes)
+                continue
+            if event == 'error':
+                print '\nError! {0}'.format(value)
+                sys.exit(1)
+            elif event == 'started':
+                job_processes[value[0]] = value[1]
+            elif event == 'part_finished':
+                split_parts[value] += 1
+                if split_parts[value] == len(vcf_file_names):
+                    job_results[('merge', value)] = pool.apply_async(
+                        run_merge_job, (value, vcf_file_dir, vcf_file_names,
+                                        temp_intermediate_dir,
+                                        output_final_vcf_dir, vcf_merge_call,
+                                        events))
+            elif event == 'finished':
+                job_results.pop(value)
+                job_processes.pop(value, None)
+                if value[0] == 'merge':
+                    merged_parts += 1
+                    print 'Part {0} merged, {1} parts left.'.format(value[1],
+                                                                   process_count - merged_parts)
+                    if merged_parts == process_count:
+                        job_results[('concatenate', 0)] = pool.apply_async(
+                            run_concatenate_job, (combined_vcf_path,
+                                                  temp_intermediate_dir,
+                                                  output_final_vcf_dir,
+                                                  vcf_merge_call is not None,
+                                                  events))
+        pool.close()
+    finally:
+        # Stops the remaining jobs if the run failed
+        pool.terminate()
+        pool.join()
+        manager.shutdown()
+
+
+def check_local_jobs(job_results, job_processes):
+    """Exits if a job has failed outside of its error handling or if the
+    process of a started job no longer exists (e.g. it was killed)"""
+    for job, result in job_results.items():
+        if result.ready() and not result.successful():
+            try:
+                result.get()
+            except Exception:
+                print '\nError! Job {0} {1} failed:\n{2}'.format(job[0], job[1],
+                                                               traceback.format_exc())
+            sys.exit(1)
+        if job in job_processes:
+            try:
+                os.kill(job_processes[job], 0)
+            except OSError:
+                print '\nError! The process of job {0} {1} was lost (killed?) ' \
+                      'before the job finished!'.format(job[0], job[1])
+                sys.exit(1)
+
+
+def run_split_job(vcf_file_path, temp_intermediate_dir, vcf_file_index,
+                  events):
+    job = ('split', vcf_file_index)
+    events.put(('started', (job, os.getpid())))
+    try:
+        split_vcf(vcf_file_path, temp_intermediate_dir,
+                  lambda part_number: events.put(('part_finished', part_number)))
+        events.put(('finished', job))
+    except SystemExit:
+        # The error has already been printed
+        events.put(('error', 'Splitting {0} failed!'.format(vcf_file_path)))
+    except BaseException:
+        events.put(('error', 'Splitting {0} failed:\n{1}'.format(vcf_file_path,
+                                                                traceback.format_exc())))
+
+
+def run_merge_job(part_number, vcf_file_dir, vcf_file_names,
+                  temp_intermediate_dir, output_final_vcf_dir, vcf_merge_call,
+                  events):
+    job = ('merge', part_number)
+    events.put(('started', (job, os.getpid())))
+    try:
+        if vcf_merge_call is None:
+            merge_part(part_number, vcf_file_dir, temp_intermediate_dir,
+                       output_final_vcf_dir)
+        else:
+            files_to_merge = [part_vcf_path(temp_intermediate_dir, part_number,
+                                            vcf_file_name) for
+                              vcf_file_name in vcf_file_names]
+            for file_path in files_to_merge:
+                subprocess.check_call(['tabix', '-f', '-p', 'vcf', file_path])
+            out_handle = open(os.path.join(output_final_vcf_dir,
+                                           '{0}.vcf'.format(part_number)), 'w')
+            subprocess.check_call('{0} {1}'.format(vcf_merge_call,
+                                                   ' '.join(files_to_merge)),
+                                  shell=True, stdout=out_handle)
+            out_handle.close()
+        events.put(('finished', job))
+    except SystemExit:
+        events.put(('error', 'Merging part {0} failed!'.format(part_number)))
+    except BaseException:
+        events.put(('error', 'Merging part {0} failed:\n{1}'.format(part_number,
+                                                                    traceback.format_exc())))
+
+
+def run_concatenate_job(out_path, temp_intermediate_dir, output_final_vcf_dir,
+                        index_parts, events):
+    job = ('concatenate', 0)
+    events.put(('started', (job, os.getpid())))
+    try:
+        concatenate_parts(out_path, temp_intermediate_dir, output_final_vcf_dir,
+                          index_parts)
+        events.put(('finished', job))
+    except SystemExit:
+        events.put(('error', 'Concatenating the parts failed!'))
+    except BaseException:
+        events.put(('error', 'Concatenating the parts failed:\n{0}'.format(traceback.format_exc())))
+
+
+def merge_part(part_number, vcf_file_dir, temp_intermediate_dir,
+               output_final_vcf_dir):
+    """Merges the split vcf files of a part"""
+    if vcf_file_dir is None or temp_intermediate_dir is None or \
+            output_final_vcf_dir is None:
+        print 'Error! Input vcf file directory (-v), intermediate file ' \
+              'directory (-t) and output directory (-d) are required with -M!'
+        sys.exit(0)
+    part_count, scaffold_intervals, scaffold_order = read_reference_parts(
+        os.path.join(temp_intermediate_dir, 'reference_parts.bed'))
+    vcf_file_paths = [part_vcf_path(temp_intermediate_dir, part_number,
+                                    vcf_file_name) for
+                      vcf_file_name in list_vcf_files(vcf_file_dir)]
+    out_path = os.path.join(output_final_vcf_dir, '{0}.vcf'.format(part_number))
+    print '\nMerging {0} vcf files into {1}...'.format(len(vcf_file_paths),
+                                                       out_path)
+    records = merge_vcfs(vcf_file_paths, out_path, scaffold_order)
+    print 'Wrote {0} records.'.format(records)
+
+
+def open_vcf(vcf_file_path):
+    if vcf_file_path.endswith('.gz'):
+        return gzip.open(vcf_file_path)
+    return open(vcf_file_path)
+
+
+def merge_vcfs(vcf_file_paths, out_path, scaffold_order):
+    """Merges sorted vcf files into out_path by reading them simultaneously.
+    Records are ordered by scaffold_order (scaffold -> order) and position.
+    Returns the number of written records."""
+    in_handles = [open_vcf(vcf_file_path) for vcf_file_path in vcf_file_paths]
+    meta_lines = OrderedDict()
+    samples = []
+    sample_counts = []
+    for vcf_file_path, in_handle in zip(vcf_file_paths, in_handles):
+        # The records are read with readline, which can not be mixed with
+        # iterating over a file
+        while True:
+            line = in_handle.readline()
+            if not line:
+                print 'Error! No header line found in {0}!'.format(vcf_file_path)
+                sys.exit(0)
+            if line.startswith('##'):
+                meta_lines[line] = None
+            elif line.startswith('#'):
+                line = line.rstrip('\r\n').split('\t')
+                samples += line[9:]
+                sample_counts.append(len(line[9:]))
+                break
+    format_numbers = dict(FORMAT_NUMBERS)
+    for line in meta_lines:
+        # Fields such as AD are often defined with Number=., so the header
+        # only overrides the defaults with a per allele or genotype Number
+        match = re.match('##FORMAT=<ID=([^,>]+),Number=([RAG])[,>]', line)
+        if match:
+            format_numbers[match.group(1)] = match.group(2)
+
+    out_handle = open(out_path, 'w')
+    for line in meta_lines:
+        out_handle.write(line)
+    out_handle.write('\t'.join(['#CHROM', 'POS', 'ID', 'REF', 'ALT', 'QUAL',
+                                'FILTER', 'INFO', 'FORMAT'] + samples) + '\n')
+
+    # Heap of the (scaffold order, position, input index, record) of the
+    # next record of each input
+    heap = []
+    # The split next record of each input
+    current_records = [None] * len(in_handles)
+    for i in range(len(in_handles)):
+        push_next_record(heap, in_handles, current_records, i, scaffold_order,
+                         None)
+    records = 0
+    while heap:
+        key = heap[0][:2]
+        group = [None] * len(in_handles)
+        merged_inputs = []
+        while heap and heap[0][:2] == key:
+            i = heapq.heappop(heap)[2]
+            merged_inputs.append(i)
+        # The next records are added after the group is complete, since an
+        # input may have several records at the same position
+        for i in merged_inputs:
+            group[i] = current_records[i]
+            push_next_record(heap, in_handles, current_records, i,
+                             scaffold_order, key)
+        for line in merge_records(group, sample_counts, format_numbers):
+            out_handle.write(line)
+            records += 1
+    out_handle.close()
+    for in_handle in in_handles:
+        in_handle.close()
+    return records
+
+
+def push_next_record(heap, in_handles, current_records, i, scaffold_order,
+                     previous_key):
+    """Adds the next record of input i into the heap"""
+    line = in_handles[i].readline()
+    if not line:
+        return
+    record = line.rstrip('\r\n').split('\t')
+    if record[0] not in scaffold_order:
+        # Scaffolds missing from the reference come last
+        scaffold_order[record[0]] = len(scaffold_order)
+    key = (scaffold_order[record[0]], int(record[1]))
+    if previous_key is not None and key < previous_key:
+        print 'Error! Vcf file {0} is not sorted in reference order at ' \
+              '{1}:{2}!'.format(in_handles[i].name, record[0], record[1])
+        sys.exit(0)
+    current_records[i] = record
+    heapq.heappush(heap, key + (i,))
+
+
+def merge_records(group, sample_counts, format_numbers):
+    """Returns the merged lines of the records of a position. group contains
+    the split record (or None) of each input. format_numbers contains the
+    Number of the FORMAT fields, fields with one value per allele (R, A) or
+    genotype (G) are reordered for the merged alleles."""
+    refs = [record[3] for record in group if record is not None]
+    ref = max(refs, key=len)
+    # Records are compatible if their REF is a prefix of the longest REF
+    compatible = [record if record is not None and ref.startswith(record[3]) else None for
+                  record in group]
+    incompatible = [record if record is not None and not ref.startswith(record[3]) else None for
+                    record in group]
+    records = [record for record in compatible if record is not None]
+    first = records[0]
+
+    format_keys = []
+    for record in records:
+        for key in record[8].split(':'):
+            if key not in format_keys:
+                format_keys.append(key)
+    if 'GT' in format_keys:
+        format_keys.remove('GT')
+        format_keys.insert(0, 'GT')
+        missing_sample = './.'
+    else:
+        missing_sample = '.'
+
+    # The merged index of each allele index of each record
+    alts = []
+    allele_maps = []
+    for record in compatible:
+        if record is None:
+            allele_maps.append(None)
+            continue
+        # Alleles of this record get the bases of the longer REF appended
+        suffix = ref[len(record[3]):]
+        allele_map = {0: 0}
+        for allele_index, alt in enumerate(record[4].split(','), 1):
+            if alt == '.':
+                continue
+            if not (alt.startswith('<') or alt == '*'):
+                alt += suffix
+            if alt not in alts:
+                alts.append(alt)
+            allele_map[allele_index] = alts.index(alt) + 1
+        allele_maps.append(allele_map)
+
+    columns = []
+    for record, allele_map, sample_count in zip(compatible, allele_maps,
+                                                sample_counts):
+        if record is None:
+            columns += [missing_sample] * sample_count
+            continue
+        keys = record[8].split(':')
+        identity = keys == format_keys and \
+            all(index == new_index for index, new_index in allele_map.items()) and \
+            (len(allele_map) == len(alts) + 1 or
+             not any(format_numbers.get(key) in ('R', 'A', 'G') for key in keys))
+        for sample in record[9:]:
+            if identity:
+                columns.append(sample)
+                continue
+            values = dict(zip(keys, sample.split(':')))
+            for key in values:
+                if key == 'GT':
+                    values['GT'] = ''.join(allele if allele in ('/', '|', '.') else
+                                           str(allele_map.get(int(allele), '.')) for
+                                           allele in re.split('([/|])', values['GT']))
+                elif format_numbers.get(key) in ('R', 'A', 'G'):
+                    values[key] = remap_format_values(values[key],
+                                                      format_numbers[key],
+                                                      allele_map, len(alts) + 1)
+            columns.append(':'.join(values.get(key, '.') for key in format_keys))
+
+    line = '\t'.join([first[0], first[1], first[2], ref, ','.join(alts) or '.',
+                      first[5], first[6], first[7], ':'.join(format_keys)] + columns)
+    lines = [line + '\n']
+    if any(record is not None for record in incompatible):
+        lines += merge_records(incompatible, sample_counts, format_numbers)
+    return lines
+
+
+def remap_format_values(value, number, allele_map, allele_count):
+    """Reorders the values of a FORMAT field with one value per allele (R),
+    alternative allele (A) or genotype (G) into the merged alleles. Values of
+    alleles missing from the record are set to missing (.). Values not
+    matching the number of alleles of the record are set to missing."""
+    if value == '.':
+        return value
+    values = value.split(',')
+    record_allele_count = len(allele_map)
+    if number == 'A':
+        new_values = ['.'] * (allele_count - 1)
+        if len(values) != record_allele_count - 1:
+            return ','.join(new_values)
+        for allele_index, new_index in allele_map.items():
+            if allele_index:
+                new_values[new_index - 1] = values[allele_index - 1]
+    elif number == 'R' or (len(values) == record_allele_count and
+                           record_allele_count > 1):
+        # Haploid genotypes have a value per allele
+        new_values = ['.'] * allele_count
+        if len(values) != record_allele_count:
+            return ','.join(new_values)
+        for allele_index, new_index in allele_map.items():
+            new_values[new_index] = values[allele_index]
+    else:
+        # Diploid genotype j/k (j <= k) is at index k * (k + 1) / 2 + j
+        new_values = ['.'] * (allele_count * (allele_count + 1) / 2)
+        if len(values) != record_allele_count * (record_allele_count + 1) / 2:
+            return ','.join(new_values)
+        for k in range(record_allele_count):
+            for j in range(k + 1):
+                new_j, new_k = sorted((allele_map[j], allele_map[k]))
+                new_values[new_k * (new_k + 1) / 2 + new_j] = values[k * (k + 1) / 2 + j]
+    return ','.join(new_values)
+
+
+def concatenate_parts(out_path, temp_intermediate_dir, output_final_vcf_dir,
+                      index_parts):
+    """Writes the merged parts into a bgzip compressed vcf file in reference
+    order by copying the records of each interval of reference_parts.bed
+    from the merged file of its part. Without index_parts the records of
+    each part must be in reference order."""
+    if temp_intermediate_dir is None or output_final_vcf_dir is None:
+        print 'Error! Intermediate file directory (-t) and output directory ' \
+              '(-d) are required with -C!'
+        sys.exit(0)
+    part_count, scaffold_intervals, scaffold_order = read_reference_parts(
+        os.path.join(temp_intermediate_dir, 'reference_parts.bed'))
+    intervals = sorted((scaffold_order[scaffold], start, scaffold, part_number) for
+                       scaffold, intervals in scaffold_intervals.items() for
+                       start, end, part_number in intervals)
+    print '\nConcatenating {0} parts into {1}...'.format(part_count, out_path)
+
+    in_handles = {}
+    header = None
+    for part_number in range(1, part_count + 1):
+        part_path = os.path.join(output_final_vcf_dir,
+                                 '{0}.vcf'.format(part_number))
+        in_handles[part_number] = open(part_path, 'rb')
+        part_header = []
+        while True:
+            line = in_handles[part_number].readline()
+            if not line:
+                print 'Error! No header line found in {0}!'.format(part_path)
+                sys.exit(0)
+            part_header.append(line)
+            if line.startswith('#CHROM'): break
+        if header is None:
+            header = part_header
+        elif part_header[-1] != header[-1]:
+            print 'Error! The samples of {0} differ from the first part!'.format(part_path)
+            sys.exit(0)
+    out_handle = bgzf_writer(out_path)
+    out_handle.write(''.join(header))
+
+    if index_parts:
+        # Byte ranges of the scaffolds of each part
+        scaffold_ranges = {}
+        for part_number, in_handle in in_handles.items():
+            scaffold_ranges[part_number] = index_scaffolds(in_handle)
+        for order, start, scaffold, part_number in intervals:
+            if scaffold not in scaffold_ranges[part_number]:
+                continue
+            in_handle = in_handles[part_number]
+            range_start, range_end = scaffold_ranges[part_number][scaffold]
+            in_handle.seek(range_start)
+            while range_start < range_end:
+                data = in_handle.read(min(range_end - range_start, 1048576))
+                out_handle.write(data)
+                range_start += len(data)
+    else:
+        # The scaffolds of the intervals of each part in reference order
+        part_scaffolds = dict((part_number, []) for part_number in in_handles)
+        for order, start, scaffold, part_number in intervals:
+            part_scaffolds[part_number].append(scaffold)
+        # The index of the current interval of each part
+        part_interval_index = dict((part_number, 0) for part_number in in_handles)
+        next_lines = dict((part_number, in_handle.readline()) for
+                          part_number, in_handle in in_handles.items())
+        for order, start, scaffold, part_number in intervals:
+            in_handle = in_handles[part_number]
+            line = next_lines[part_number]
+            while line and line.split('\t', 1)[0] == scaffold:
+                out_handle.write(line)
+                line = in_handle.readline()
+            next_lines[part_number] = line
+            part_interval_index[part_number] += 1
+            if line and line.split('\t', 1)[0] not in \
+                    part_scaffolds[part_number][part_interval_index[part_number]:]:
+                print 'Error! The records of part {0} are not in reference ' \
+                      'order at {1}, use -i true!'.format(part_number,
+                                                          ':'.join(line.split('\t', 2)[:2]))
+                sys.exit(0)
+    out_handle.close()
+    for in_handle in in_handles.values():
+        in_handle.close()
+    print 'Concatenation done.'
+
+
+def index_scaffolds(in_handle):
+    """Returns a dict with the (start, end) byte range of each scaffold of
+    a vcf file read from the current position to the end"""
+    scaffold_ranges = {}
+    offset = in_handle.tell()
+    scaffold = None
+    for line in in_handle:
+        line_scaffold = line.split('\t', 1)[0]
+        if line_scaffold != scaffold:
+            if line_scaffold in scaffold_ranges:
+                print 'Error! The records of scaffold {0} are not consecutive ' \
+                      'in {1}!'.format(line_scaffold, in_handle.name)
+                sys.exit(0)
+            scaffold = line_scaffold
+            scaffold_ranges[scaffold] = [offset, offset]
+        offset += len(line)
+        scaffold_ranges[scaffold][1] = offset
+    return scaffold_ranges
+
+
+class bgzf_writer:
+    """Writes a bgzip compressed file. The file can be closed between writes
+    with suspend to limit the number of open files."""
+    def __init__(self, path):
+        self.path = path
+        self.handle = open(path, 'wb')
+        self.buffer = []
+        self.buffer_size = 0
+
+    def write(self, data):
+        if self.handle is None:
+            self.handle = open(self.path, 'ab')
+        self.buffer.append(data)
+        self.buffer_size += len(data)
+        if self.buffer_size >= BGZF_BLOCK_SIZE:
+            data = ''.join(self.buffer)
+            while len(data) >= BGZF_BLOCK_SIZE:
+                self.write_block(data[:BGZF_BLOCK_SIZE])
+                data = data[BGZF_BLOCK_SIZE:]
+            self.buffer = [data]
+            self.buffer_size = len(data)
+
+    def write_block(self, data):
+        compressor = zlib.compressobj(6, zlib.DEFLATED, -15)
+        compressed_data = compressor.compress(data) + compressor.flush()
+        # Header (18 bytes) with the block size in the BC extra field, the
+        # compressed data, crc32 and data size (8 bytes)
+        self.handle.write(struct.pack('<4BI2BH2BHH', 31, 139, 8, 4, 0, 0, 255,
+                                      6, 66, 67, 2, len(compressed_data) + 25))
+        self.handle.write(compressed_data)
+        self.handle.write(struct.pack('<2I', zlib.crc32(data) & 0xffffffff,
+                                      len(data)))
+
+    def flush(self):
+        if self.buffer_size:
+            self.write_block(''.join(self.buffer))
+        self.buffer = []
+        self.buffer_size = 0
+
+    def suspend(self):
+        self.flush()
+        self.handle.close()
+        self.handle = None
+
+    def close(self):
+        if self.handle is None:
+            self.handle = open(self.path, 'ab')
+        self.flush()
+        self.handle.write(BGZF_EOF)
+        self.handle.close()
+        self.handle = None
+
+
+def read_reference_sizes(reference_path, write_fai):
+    """Returns dicts of reference scaffold sizes and their order in the
+    reference (starting from 1). Sizes are read from the .fai index if it
+    exists, otherwise from the sequence line lengths of the fasta file."""
+    reference_sequence_sizes = {}
+    reference_sequence_order = {}
+    fai_path = reference_path + '.fai'
+    if os.path.isfile(fai_path):
+        print '\nReading reference genome index...'
+        in_handle = open(fai_path)
+        for line in in_handle:
+            line = line.strip()
+            if not line: continue
+            line = line.split('\t')
+            reference_sequence_sizes[line[0]] = int(line[1])
+            reference_sequence_order[line[0]] = len(reference_sequence_order) + 1
+        in_handle.close()
+        return reference_sequence_sizes, reference_sequence_order
+
+    print '\nReading reference genome...'
+    try:
+        in_handle = open(reference_path, 'rb')
+    except:
+        print '\n\nError! Unable to open refence genome, reason\n\n'
+        raise
+    # Fasta index lines as [name, length, offset, line bases, line width]
+    fai_lines = []
+    # An index can only be written if all lines of a scaffold except the last
+    # one have the same length
+    fai_valid = True
+    last_line_found = False
+    offset = 0
+    for line in in_handle:
+        offset += len(line)
+        if line.startswith('>'):
+            scaffold = line[1:].split()[0]
+            fai_lines.append([scaffold, 0, offset, 0, 0])
+            reference_sequence_order[scaffold] = len(fai_lines)
+            last_line_found = False
+            continue
+        line_bases = len(line.strip())
+        if not fai_lines:
+            if not line_bases: continue
+            print '\n\nError when reading reference file:\n{0}'.format(reference_path)
+            print 'This does not seem like a fasta file, since first line does not contain > ' \
+                  'character!'
+            sys.exit(0)
+        fai_line = fai_lines[-1]
+        fai_line[1] += line_bases
+        if not write_fai: continue
+        if not line_bases:
+            # Blank lines are only allowed at the end of a scaffold
+            last_line_found = True
+        elif last_line_found:
+            fai_valid = False
+        elif fai_line[3] == 0:
+            fai_line[3] = line_bases
+            fai_line[4] = len(line)
+        elif line_bases > fai_line[3] or \
+                len(line) - line_bases != fai_line[4] - fai_line[3]:
+            fai_valid = False
+        elif line_bases < fai_line[3]:
+            last_line_found = True
+    in_handle.close()
+    if not fai_lines:
+        print '\n\nError! No sequences found in the reference file!'
+        sys.exit(0)
+    for fai_line in fai_lines:
+        reference_sequence_sizes[fai_line[0]] = fai_line[1]
+
+    if write_fai:
+        if fai_valid:
+            out_handle = open(fai_path, 'w')
+            for fai_line in fai_lines:
+                out_handle.write('\t'.join(map(str, fai_line)) + '\n')
+            out_handle.close()
+            print 'Wrote reference genome index {0}'.format(fai_path)
+        else:
+            print 'Warning! Unable to write reference genome index since the ' \
+                  'sequence lines of the reference are not of equal length!'
+    return reference_sequence_sizes, reference_sequence_order
+
+
+if args.split_vcf is not None:
+    split_vcf(args.split_vcf, args.temp_intermediate_dir)
+elif args.benchmark is not None:
+    benchmark(args.benchmark, args.input_vcf_file_dir,
+              args.temp_intermediate_dir, args.vcf_merge_call)
+elif args.concatenate is not None:
+    if args.index_parts is None or args.index_parts.lower() in ('f', 'false'):
+        index_parts = False
+    elif args.index_parts.lower() in ('t', 'true'):
+        index_parts = True
+    else:
+        print 'Error! Odd value for -i parameter. Allowed values are "true" and "false"!'
+        sys.exit(0)
+    concatenate_parts(args.concatenate, args.temp_intermediate_dir,
+                      args.output_final_vcf_dir, index_parts)
+elif args.merge_part is not None:
+    merge_part(args.merge_part, args.input_vcf_file_dir,
+               args.temp_intermediate_dir, args.output_final_vcf_dir)
+else:
+    vcfcombineParallelizer(args.output_final_vcf_dir,
+                           args.reference_path,
+                           args.process_count,
+                           args.output_slurm_files_dir,
+                           args.input_vcf_file_dir,
+                           args.temp_intermediate_dir,
+                           args.job_name,
+                           args.vcf_merge_call,
+                           args.load_environment_module,
+                           args.write_fai,
+                           args.split_scaffolds,
+                           args.work_samples,
+                           args.local_processes,
+                           args.calibration,
+                           args.slurm_partitions)